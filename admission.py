@@ -0,0 +1,191 @@
+#
+
+# Queries waiting for a member of a pool.
+#
+# Every pool has an AdmissionQueue. Waiters are ordered by priority (if
+# the queue is configured for that) and then by a fair-queueing tag per
+# client, so one client submitting a hundred queries can't make everyone
+# else wait behind all of them. When a member becomes available only the
+# waiter at the head of the queue is woken. A waiter that needs more memory
+# than any member has left holds up the ones behind it; letting those
+# pass would leave it waiting for as long as small queries keep coming.
+
+from collections import deque
+import heapq
+import threading
+import time
+
+
+class Rejected(Exception):
+    """The queue was full or the query waited past its deadline."""
+
+
+class Waiter:
+    """A place in an AdmissionQueue, see AdmissionQueue.enter"""
+
+    def __init__(self, queue, client, priority, deadline, entered, footprint):
+        self.client = client
+        self.priority = priority
+        self.deadline = deadline
+        self.footprint = footprint
+        self.entered = entered
+        self._queue = queue
+        self._event = threading.Event()
+        self._claim = None
+        self._cancelled = False
+
+    def wait(self, timeout=None):
+        """Wait for a claim, at most timeout seconds.
+
+        Returns the claim, or None on timeout; the Waiter then keeps
+        its place. Raises Rejected and leaves the queue when the deadline
+        passes.
+        """
+        queue = self._queue
+        limit = None if timeout is None else queue._clock() + timeout
+        while True:
+            now = queue._clock()
+            until = [t for t in (limit, self.deadline) if t is not None]
+            remaining = min(until) - now if until else None
+            if self._event.wait(remaining if remaining is None else max(0, remaining)):
+                return self._claim
+            now = queue._clock()
+            if self.deadline is not None and now >= self.deadline:
+                if queue._expire(self):
+                    raise Rejected(f"Waited more than {now - self.entered:.1f}s for pool {queue.name}")
+                # granted at the last moment
+                return self._claim
+            if limit is not None and now >= limit:
+                return None
+
+    def cancel(self):
+        """Leave the queue. A claim that was granted meanwhile is released."""
+        claim = self._queue._cancel(self)
+        if claim:
+            claim.release()
+
+
+class AdmissionQueue:
+    """Waiting line for one pool.
+
+    claim is a function taking a footprint keyword and returning a Claim
+    or None, usually Pool.claim.
+    With ordering 'priority', waiters with a higher priority go first;
+    with 'fifo' priorities are ignored. With fair, waiters of the same
+    priority take turns per client rather than strictly in order of
+    arrival.
+    """
+
+    def __init__(self, name, claim, max_depth=100, ordering='fifo', fair=True, clock=time.time):
+        if ordering not in ('fifo', 'priority'):
+            raise Exception(f"Unknown queue ordering {ordering}, try fifo or priority")
+        self.name = name
+        self.max_depth = max_depth
+        self.ordering = ordering
+        self.fair = fair
+        self._claim = claim
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._heap = []
+        self._seq = 0
+        self._depth = 0
+        # fair queueing: tag of the last admitted waiter and the last
+        # tag handed to each client
+        self._virtual = 0
+        self._last_tag = {}
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self._waits = deque(maxlen=1000)
+
+    depth = property(lambda self: self._depth, doc="number of waiters")
+
+    def enter(self, client=None, priority=0, deadline=None, footprint=None):
+        """Join the queue. deadline is in seconds from now, footprint is
+        passed on to claim.
+
+        Raises Rejected if the queue is full. The Waiter may have been
+        granted a claim already, use Waiter.wait to get it.
+        """
+        now = self._clock()
+        with self._lock:
+            if self._depth >= self.max_depth:
+                self.rejected += 1
+                raise Rejected(f"Too many queries waiting for pool {self.name}")
+            w = Waiter(self, client, priority, None if deadline is None else now + deadline, now, footprint)
+            self._seq += 1
+            if self.fair:
+                tag = max(self._virtual, self._last_tag.get(client, 0)) + 1
+                self._last_tag[client] = tag
+            else:
+                tag = self._seq
+            if self.ordering == 'priority':
+                key = (-priority, tag, self._seq)
+            else:
+                key = (tag, self._seq)
+            heapq.heappush(self._heap, (key, w))
+            self._depth += 1
+            w._tag = tag
+        self.dispatch()
+        return w
+
+    def dispatch(self):
+        """Hand out claims to the waiters at the head of the queue for as
+        long as there are members to claim."""
+        with self._lock:
+            while self._heap:
+                key, w = self._heap[0]
+                if w._cancelled:
+                    heapq.heappop(self._heap)
+                    continue
+                c = self._claim(footprint=w.footprint)
+                if not c:
+                    break
+                heapq.heappop(self._heap)
+                self._depth -= 1
+                self._virtual = max(self._virtual, w._tag)
+                self.admitted += 1
+                self._waits.append(self._clock() - w.entered)
+                w._claim = c
+                w._event.set()
+            if not self._heap:
+                # nobody waiting, no need to remember who had which turn
+                self._last_tag.clear()
+
+    def _remove(self, w):
+        # with the lock held; True if w was still waiting
+        if w._cancelled or w._claim:
+            return False
+        w._cancelled = True
+        self._depth -= 1
+        return True
+
+    def _expire(self, w):
+        with self._lock:
+            if self._remove(w):
+                self.expired += 1
+                self._waits.append(self._clock() - w.entered)
+                return True
+            return False
+
+    def _cancel(self, w):
+        with self._lock:
+            if self._remove(w):
+                return None
+            claim, w._claim = w._claim, None
+            w._cancelled = True
+            return claim
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            oldest = min((w.entered for _, w in self._heap if not w._cancelled), default=None)
+            return dict(
+                depth=self._depth,
+                admitted=self.admitted,
+                rejected=self.rejected,
+                expired=self.expired,
+                oldest_wait=self._clock() - oldest if oldest is not None else 0,
+                mean_wait=sum(waits) / len(waits) if waits else 0,
+                p95_wait=waits[int(0.95 * (len(waits) - 1))] if waits else 0,
+            )
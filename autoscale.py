@@ -0,0 +1,103 @@
+#
+
+# Deciding how many members a pool should have.
+#
+# A policy turns the load of a pool into the load we should be ready
+# for. decide() then applies the rules that hold whatever the policy:
+# don't drop everything right after startup, eventually stop the last
+# minion and always have one for a query that is waiting.
+
+import math
+
+
+class ReactivePolicy:
+    """Be ready for the current load, what the conductor always did"""
+
+    name = 'load'
+
+    def forecast(self, now, load):
+        return load
+
+
+class HoltPolicy(ReactivePolicy):
+    """Be ready for the load we expect lead seconds from now.
+
+    Follows the level and trend of the load with Holt's double exponential
+    smoothing. The load is sampled irregularly so the smoothing factors
+    are derived from time constants in seconds rather than fixed per
+    sample. Never asks for less than the current load, so it only ever
+    adds to what ReactivePolicy would ask for.
+    """
+
+    name = 'forecast'
+
+    def __init__(self, lead=60, level_time=30, trend_time=60):
+        # Looking further ahead than this mostly costs VM-minutes,
+        # see backtest_autoscale.py
+        self.lead = lead
+        self.level_time = level_time
+        self.trend_time = trend_time
+        self._level = None
+        # load per second
+        self._trend = 0.0
+        self._last = None
+
+    def _update(self, now, load):
+        if self._level is None:
+            self._level = load
+            self._last = now
+            return
+        dt = now - self._last
+        if dt <= 0:
+            return
+        a = 1 - math.exp(-dt / self.level_time)
+        b = 1 - math.exp(-dt / self.trend_time)
+        level = a * load + (1 - a) * (self._level + self._trend * dt)
+        self._trend = b * (level - self._level) / dt + (1 - b) * self._trend
+        self._level = level
+        self._last = now
+
+    def forecast(self, now, load):
+        self._update(now, load)
+        expected = self._level + self._trend * self.lead
+        return max(load, expected)
+
+
+POLICIES = dict(
+    reactive=ReactivePolicy,
+    holt=HoltPolicy,
+)
+
+
+def decide(policy, now, loadavg, ups, members, waiting):
+    """Return the desired size of a pool and the reason for it.
+
+    loadavg is the pool's LoadAverage (or anything with load,
+    time_running and time_since_change), ups the number of UP members,
+    members the total number of members and waiting the number of queries
+    waiting for a member.
+    """
+    load = loadavg.load
+
+    # Ground rule: desired is load, rounded upward.
+    new_desired = int(math.ceil(policy.forecast(now, load)))
+    reason = policy.name
+
+    # On start, load==0. We don't want to immediately shut down all minions.
+    bottom = max(0, int(ups - math.floor(loadavg.time_running / 60)))
+    if new_desired < bottom:
+        new_desired = bottom
+        reason = "keep some running initially"
+
+    # ceil(load) will never be 0.0 once load has been > 0.
+    # This means that new_desired will stay >= 0 forever.
+    # At some point we have to shut down the last minion.
+    if bottom == 0 and new_desired == 1 and loadavg.time_since_change > 15 * 60 and load < 0.1:
+        new_desired = 0
+        reason = "no recent activity"
+
+    if new_desired == 0 and waiting > 0:
+        new_desired = 1
+        reason = "triggered"
+
+    return min(new_desired, members), reason
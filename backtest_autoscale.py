@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Replay the pool loads recorded in a status timeline such as data.json
+# through the autoscale policies and report how long queries would have
+# waited for a minion and how many VM-minutes each policy costs.
+#
+# Usage: backtest_autoscale.py [TIMELINE] [--boot SECONDS] [--members N]
+#
+# TIMELINE is a JSON list of {"timestamp": ms, "stats": {pool: {"load": ...}}}
+# as collected from the status feed; it defaults to data.json.
+#
+# This is a fluid model: the recorded load is taken as the number of
+# queries that want a minion, every UP minion serves one of them and the
+# rest waits. A minion takes --boot seconds to come up and stops right
+# away. The recorded load doesn't include queries that were waiting
+# because no minion was up, so the waiting times are a lower bound.
+# See simulator.py for replaying individual queries.
+
+import argparse
+import json
+
+import autoscale
+
+
+class RecordedLoad:
+    # Looks like a LoadAverage to autoscale.decide
+    def __init__(self, start):
+        self.load = 0.0
+        self.time_running = 0.0
+        self.time_since_change = 0.0
+        self._start = start
+        self._last_change = start
+
+    def update(self, now, load):
+        # The load decays smoothly after a release, a rise means a claim
+        if load > self.load + 1e-6:
+            self._last_change = now
+        self.load = load
+        self.time_running = now - self._start
+        self.time_since_change = now - self._last_change
+
+
+def load_timeline(path):
+    with open(path) as f:
+        data = json.load(f)
+    timelines = {}
+    for entry in data:
+        t = entry['timestamp'] / 1000.0
+        for name, stats in entry['stats'].items():
+            timelines.setdefault(name, []).append((t, stats['load'], stats.get('up', 0)))
+    return timelines
+
+
+def backtest(policy, timeline, boot, members, step=1.0):
+    start, _, up = timeline[0]
+    end = timeline[-1][0]
+    recorded = RecordedLoad(start)
+    starting = []
+    waited = 0.0
+    vm_seconds = 0.0
+    longest_queue = 0.0
+    i = 0
+    t = start
+    while t <= end:
+        while i + 1 < len(timeline) and timeline[i + 1][0] <= t:
+            i += 1
+        load = timeline[i][1]
+        recorded.update(t, load)
+
+        # minions that finished booting
+        ready = [s for s in starting if s <= t]
+        starting = [s for s in starting if s > t]
+        up += len(ready)
+
+        queue = max(0.0, load - up)
+        waiting = queue if up == 0 else 0
+        desired, _ = autoscale.decide(policy, t, recorded, up, members, waiting)
+        while up + len(starting) < desired:
+            starting.append(t + boot)
+        while up + len(starting) > desired:
+            if starting:
+                # the one that started last has the longest to go
+                starting.pop()
+            else:
+                up -= 1
+
+        queue = max(0.0, load - up)
+        longest_queue = max(longest_queue, queue)
+        waited += queue * step
+        vm_seconds += (up + len(starting)) * step
+        t += step
+    return dict(waited=waited, vm_minutes=vm_seconds / 60, longest_queue=longest_queue)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest autoscale policies against a recorded load timeline")
+    parser.add_argument('timeline', nargs='?', default='data.json')
+    parser.add_argument('--boot', type=float, default=120, help="seconds for a minion to come up")
+    parser.add_argument('--members', type=int, default=8, help="members per pool")
+    args = parser.parse_args()
+
+    timelines = load_timeline(args.timeline)
+    for name, timeline in sorted(timelines.items()):
+        minutes = (timeline[-1][0] - timeline[0][0]) / 60
+        print(f"Pool {name}, {len(timeline)} samples over {minutes:.0f} minutes:")
+        for policy_name, policy_class in autoscale.POLICIES.items():
+            result = backtest(policy_class(), timeline, args.boot, args.members)
+            print(f"  {policy_name:>9}: waited {result['waited'] / 60:6.1f} query-minutes, "
+                  f"longest queue {result['longest_queue']:4.1f}, {result['vm_minutes']:6.1f} VM-minutes")
+
+
+if __name__ == "__main__":
+    main()
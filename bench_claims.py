@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Drive a Pool of fake minions with synthetic bursty query arrivals on a
+# virtual clock and report the latency each claim strategy gives.
+#
+# Every minion runs its queries processor-sharing style on a few cores,
+# and some minions are slower than others, like a noisy neighbour would
+# make them.
+#
+# Usage: bench_claims.py [QUERIES]
+
+import math
+import random
+import sys
+
+from fakes import fake_minions
+import pool
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Job:
+    def __init__(self, claim, work, arrived):
+        self.claim = claim
+        self.remaining = work
+        self.arrived = arrived
+
+
+def arrivals(rng, mean_rate, burst_factor=3.0, phase=60.0):
+    """Poisson arrivals whose rate alternates between a quiet and a busy
+    phase, with mean_rate as the long term average."""
+    t = 0.0
+    quiet = mean_rate * 2 / (1 + burst_factor)
+    busy = quiet * burst_factor
+    phase_end = phase
+    rate = quiet
+    while True:
+        t += rng.expovariate(rate)
+        while t > phase_end:
+            phase_end += phase
+            rate = busy if rate == quiet else quiet
+        yield t
+
+
+def work(rng):
+    # mostly short lookups, now and then something big
+    if rng.random() < 0.9:
+        return rng.lognormvariate(math.log(2), 0.5)
+    return rng.lognormvariate(math.log(60), 0.5)
+
+
+def simulate(strategy, queries, nminions=8, cores=2, utilization=0.7, seed=42):
+    rng = random.Random(seed)
+    random.seed(seed)
+    clock = VirtualClock()
+    members = fake_minions(nminions)
+    speed = dict((m.name, 0.5 if i % 4 == 0 else 1.0) for i, m in enumerate(members))
+    p = pool.Pool("SIM", members, strategy, clock)
+
+    mean_work = 0.9 * 2 * math.exp(0.125) + 0.1 * 60 * math.exp(0.125)
+    capacity = sum(speed.values()) * cores
+    arrival_times = arrivals(rng, utilization * capacity / mean_work)
+
+    running = dict((m.name, []) for m in members)
+    latencies = []
+    next_arrival = next(arrival_times)
+    submitted = 0
+
+    def rate(name):
+        return speed[name] * min(1.0, cores / len(running[name]))
+
+    while len(latencies) < queries:
+        next_completion = math.inf
+        for name, jobs in running.items():
+            if jobs:
+                t = clock.now + min(j.remaining for j in jobs) / rate(name)
+                next_completion = min(next_completion, t)
+        now = min(next_arrival, next_completion) if submitted < queries else next_completion
+
+        elapsed = now - clock.now
+        for name, jobs in running.items():
+            if jobs:
+                r = rate(name)
+                for j in jobs:
+                    j.remaining -= elapsed * r
+        clock.now = now
+
+        if now == next_arrival and submitted < queries:
+            claim = p.claim()
+            running[claim.name].append(Job(claim, work(rng), now))
+            submitted += 1
+            next_arrival = next(arrival_times)
+        for name, jobs in running.items():
+            for j in [j for j in jobs if j.remaining <= 1e-9]:
+                jobs.remove(j)
+                j.claim.release()
+                latencies.append(now - j.arrived)
+
+    return latencies
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def main(queries):
+    print(f"{queries} queries")
+    for name, cls in pool.STRATEGIES.items():
+        latencies = simulate(cls(), queries)
+        print(f"{name:>8}: p50 {percentile(latencies, 50):7.1f}s  p95 {percentile(latencies, 95):7.1f}s  p99 {percentile(latencies, 99):7.1f}s  max {max(latencies):7.1f}s")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Compare the old regex-per-row bind extraction with malplan.bound_columns,
+# which is what the adviser uses without a memory model, and with
+# malplan.summarize, which the memory model needs.
+#
+# Usage: bench_malplan.py [PLANFILE...]
+#
+# A plan file holds the output of EXPLAIN, one MAL statement per line,
+# for example as saved by mclient -f raw -s 'EXPLAIN SELECT ...'.
+# Without plan files a synthetic plan with the shape of TPC-H Q9 is used.
+
+import re
+import sys
+import timeit
+
+import malplan
+
+
+def legacy_bound_columns(rows):
+    # this is what teiresias.Adviser.estimate used to do
+    def get_name(_str):
+        m = re.search(":", _str)
+        return m.string[1:m.end()-2]
+    columns = set()
+    for row in rows:
+        if re.search(r"sql.bind\(.*", str(row)) != None:
+            substrs = re.split(r'\s+', str(row))
+            schema = get_name(substrs[4])
+            table = get_name(substrs[5])
+            column = get_name(substrs[6])
+            columns.add((schema, table, column))
+    return columns
+
+
+def synthetic_plan(tables=6, columns_per_table=6, partitions=8):
+    rows = [('function user.main():void;',), ('    X_1:void := querylog.define("explain select ...":str, "default_pipe":str, 120:int);',)]
+    n = 2
+    for t in range(tables):
+        table = f"table{t}"
+        for p in range(partitions):
+            rows.append((f'    C_{n}:bat[:oid] := sql.tid(X_1:int, "sys":str, "{table}":str, {p}:int, {partitions}:int);',))
+            n += 1
+            for c in range(columns_per_table):
+                rows.append((f'    X_{n}:bat[:int] := sql.bind(X_1:int, "sys":str, "{table}":str, "col{c}":str, 0:int, {p}:int, {partitions}:int);',))
+                n += 1
+                rows.append((f'    X_{n}:bat[:int] := algebra.projection(C_{n-c-2}:bat[:oid], X_{n-1}:bat[:int]);',))
+                n += 1
+            rows.append((f'    X_{n}:bat[:oid] := sql.bindidx(X_1:int, "sys":str, "{table}":str, "{table}_fkey":str, 0:int, {p}:int, {partitions}:int);',))
+            n += 1
+    rows.append(('end user.main;',))
+    return rows
+
+
+def load_plan(path):
+    with open(path) as f:
+        return [(line.rstrip('\n'),) for line in f if line.strip()]
+
+
+def main(paths):
+    if paths:
+        plans = [(p, load_plan(p)) for p in paths]
+    else:
+        plans = [('synthetic', synthetic_plan())]
+
+    for name, rows in plans:
+        old = legacy_bound_columns(rows)
+        new = malplan.bound_columns(rows)
+        if old != new:
+            print(f"{name}: results differ! legacy {len(old)} columns, malplan {len(new)}")
+        n = 200
+        t_old = min(timeit.repeat(lambda: legacy_bound_columns(rows), number=n, repeat=3)) / n
+        t_new = min(timeit.repeat(lambda: malplan.bound_columns(rows), number=n, repeat=3)) / n
+        t_summary = min(timeit.repeat(lambda: malplan.summarize(rows), number=n, repeat=3)) / n
+        if malplan.summarize(rows).columns != new:
+            print(f"{name}: summarize finds other columns than bound_columns!")
+        print(f"{name}: {len(rows)} lines, {len(new)} columns, legacy {t_old * 1e6:.0f}us, "
+              f"bound_columns {t_new * 1e6:.0f}us ({t_old / t_new:.1f}x), summarize {t_summary * 1e6:.0f}us")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
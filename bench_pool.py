@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Time Pool bookkeeping for pools of hundreds of fake minions.
+#
+# Usage: bench_pool.py [SIZE...]
+
+import contextlib
+import io
+import sys
+import threading
+import time
+
+from fakes import fake_minions
+from minions import STOPPED
+import pool
+
+
+def timed(f, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        f()
+    return (time.perf_counter() - t0) / repeat
+
+
+def bench(size):
+    p = pool.Pool("BENCH", fake_minions(size))
+
+    # half of the members busy
+    held = [p.claim() for _ in range(size // 2)]
+
+    def claim_release():
+        p.claim().release()
+    t_claim = timed(claim_release, 2000)
+
+    t_poll = timed(p.poll, 20)
+
+    for c in held:
+        c.release()
+
+    def settle():
+        # until the pool is done changing
+        while True:
+            before = p.members()
+            p.poll()
+            if p.members() == before:
+                break
+
+    def resize():
+        p.desired = 0
+        settle()
+        p.desired = size
+        settle()
+    t_resize = timed(resize, 5)
+
+    # claims while another thread polls members that are slow to refresh
+    for m in p._by_name.values():
+        m.refresh_delay = 0.0005
+    poller = threading.Thread(target=p.poll)
+    poller.start()
+    worst = 0
+    while poller.is_alive():
+        t0 = time.perf_counter()
+        p.claim().release()
+        worst = max(worst, time.perf_counter() - t0)
+        time.sleep(0.001)
+    poller.join()
+
+    return (f"{size:5d} members: claim+release {t_claim * 1e6:7.1f}us, poll {t_poll * 1e3:6.2f}ms, shrink+grow {t_resize * 1e3:7.2f}ms, worst claim during slow poll {worst * 1e3:6.2f}ms")
+
+
+def main(sizes):
+    for size in sizes:
+        # Pool prints every state change
+        with contextlib.redirect_stdout(io.StringIO()):
+            line = bench(size)
+        print(line)
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [100, 200, 400, 800])
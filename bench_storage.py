@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Compare memory use and lookup speed of teiresias.Storage with the
+# dict-of-strings representation it used to have.
+#
+# Usage: bench_storage.py [NCOLUMNS]
+
+import random
+import sys
+import timeit
+import tracemalloc
+
+import teiresias
+
+
+class DictStorage:
+    # what teiresias.Storage used to look like
+    def __init__(self):
+        self.colsizes = {}
+
+    def set_colsize(self, schema, table, column, size):
+        self.colsizes[schema + "." + table + "." + column] = size
+
+    def get_colsize(self, schema, table, column):
+        return self.colsizes[schema + "." + table + "." + column]
+
+
+TPCH = {
+    'region': ['r_regionkey', 'r_name', 'r_comment'],
+    'nation': ['n_nationkey', 'n_name', 'n_regionkey', 'n_comment'],
+    'part': ['p_partkey', 'p_name', 'p_mfgr', 'p_brand', 'p_type', 'p_size',
+             'p_container', 'p_retailprice', 'p_comment'],
+    'supplier': ['s_suppkey', 's_name', 's_address', 's_nationkey', 's_phone',
+                 's_acctbal', 's_comment'],
+    'partsupp': ['ps_partkey', 'ps_suppkey', 'ps_availqty', 'ps_supplycost',
+                 'ps_comment'],
+    'customer': ['c_custkey', 'c_name', 'c_address', 'c_nationkey', 'c_phone',
+                 'c_acctbal', 'c_mktsegment', 'c_comment'],
+    'orders': ['o_orderkey', 'o_custkey', 'o_orderstatus', 'o_totalprice',
+               'o_orderdate', 'o_orderpriority', 'o_clerk', 'o_shippriority',
+               'o_comment'],
+    'lineitem': ['l_orderkey', 'l_partkey', 'l_suppkey', 'l_linenumber',
+                 'l_quantity', 'l_extendedprice', 'l_discount', 'l_tax',
+                 'l_returnflag', 'l_linestatus', 'l_shipdate', 'l_commitdate',
+                 'l_receiptdate', 'l_shipinstruct', 'l_shipmode', 'l_comment'],
+}
+
+
+def names(ncolumns, shared):
+    # TPC-H-like tables, 61 columns per schema. With shared, every schema
+    # is a copy of TPC-H at another scale factor, so tables share their
+    # layout across schemas. Without, every table has columns of its own,
+    # the worst case for Storage.
+    result = []
+    i = 0
+    while len(result) < ncolumns:
+        for table, columns in TPCH.items():
+            for column in columns:
+                if shared:
+                    result.append((f"sf{i}", table, column))
+                else:
+                    prefix, rest = column.split('_', 1)
+                    result.append((f"db{i // 8}", f"{table}{i}", f"{prefix}{i}_{rest}"))
+        i += 1
+    return result[:ncolumns]
+
+
+def build(cls, triples):
+    # the names exist already, only what the representation adds to them
+    # is measured
+    strg = cls()
+    for i, (schema, table, column) in enumerate(triples):
+        strg.set_colsize(schema, table, column, 1_000_000 + i)
+    return strg
+
+
+def measure_memory(cls, triples):
+    tracemalloc.start()
+    strg = build(cls, triples)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return strg, size
+
+
+def main(ncolumns):
+    for shared in (False, True):
+        triples = names(ncolumns, shared)
+        old, old_mem = measure_memory(DictStorage, triples)
+        new, new_mem = measure_memory(teiresias.Storage, triples)
+        kind = "TPC-H copies" if shared else "distinct tables"
+        print(f"{ncolumns} columns, {kind}: dict {old_mem / 1024 / 1024:.1f} MiB, Storage {new_mem / 1024 / 1024:.1f} MiB")
+
+    # the columns of a typical query
+    query_columns = set(random.sample(triples, 30))
+
+    def old_estimate():
+        total = 0
+        for schema, table, column in query_columns:
+            total += old.get_colsize(schema, table, column)
+        return total
+
+    def new_estimate():
+        return new.total_size(query_columns)
+
+    assert old_estimate() == new_estimate()
+    n = 20000
+    t_old = min(timeit.repeat(old_estimate, number=n, repeat=3)) / n
+    t_new = min(timeit.repeat(new_estimate, number=n, repeat=3)) / n
+    print(f"sum of {len(query_columns)} columns: dict {t_old * 1e6:.1f}us, Storage.total_size {t_new * 1e6:.1f}us")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
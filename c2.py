@@ -11,6 +11,7 @@ import minions
 from pool import Pool
 
 ec2 = boto3.resource('ec2')
+instance_states = minions.InstanceStateCache(ec2)
 
 # left here by Ansible who got it from Terraform
 cluster_name = open(os.path.expanduser('~/.cluster_name')).read().strip()
@@ -19,12 +20,14 @@ large_minions = minions.track_down_minions(
     ec2,
     dict(cluster=cluster_name,
          cluster_groups='minions',
-         size='large'))
+         size='large'),
+    instance_states)
 small_minions = minions.track_down_minions(
     ec2,
     dict(cluster=cluster_name,
          cluster_groups='minions',
-         size='small'))
+         size='small'),
+    instance_states)
 
 large_pool = Pool("LARGE", large_minions)
 small_pool = Pool("SMALL", small_minions)
@@ -74,6 +77,7 @@ while 1:
         print("===")
         small_pool.allow_shrink = large_pool.actual >= large_pool.desired
         large_pool.allow_shrink = small_pool.actual >= small_pool.desired
+        instance_states.refresh()
         large_pool.poll()
         small_pool.poll()
 
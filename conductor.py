@@ -27,6 +27,9 @@ serverPort = 8080
 # backend config
 explainer_mapi_url = 'mapi:monetdb://localhost:50000/SF-0_01'
 minion_mapi_url = f'mapi:monetdb://HOSTNAME:50000/SF-{scale_factor.replace(".", "_")}'
+# storage statistics from the previous run, so we can advise before
+# the first minion is up
+storage_snapshot = os.path.expanduser(f'~/.storage_SF-{scale_factor.replace(".", "_")}')
 
 # left here by Ansible who got it from Terraform
 cluster_name = open(os.path.expanduser('~/.cluster_name')).read().strip()
@@ -44,6 +47,12 @@ backend = conductor_backend.make_backend(
     conductor_backend.Connector(explainer_mapi_url),
     conductor_backend.Connector(minion_mapi_url),
     dict(SMALL=small_pool_filter, LARGE=large_pool_filter),
+    storage_snapshot=storage_snapshot,
+    # rather a LARGE minion now than a SMALL one in a minute
+    spillover='idle',
+    allow_resize=True,
+    # several small queries can share a minion now
+    weigh_load=True,
 )
 
 
@@ -1,7 +1,6 @@
 
 from collections import defaultdict
 import io
-import math
 import threading
 import time
 import urllib
@@ -10,8 +9,12 @@ import uuid
 import boto3
 import pymonetdb
 
+from admission import AdmissionQueue, Rejected
+import autoscale
+import connections
 import minions
 import pool
+from resultcache import ResultCache, result_size
 import teiresias
 
 # actually maybe caller should pass this in but we don't bother
@@ -19,77 +22,141 @@ ec2 = boto3.resource('ec2')
 
 
 class Backend:
-    def __init__(self, pools, specs, explainer_connector, minion_connector):
+    # seconds between refreshes of the storage statistics
+    storage_refresh_interval = 300
+    # every so many refreshes, reload everything instead of only the tables
+    # whose row count changed
+    storage_full_refresh = 12
+    # seconds between polls while minions are starting or stopping
+    poll_interval = 0.5
+    # when nothing is going on the interval doubles up to this
+    max_poll_interval = 8
+    # after a wakeup, wait this long so a burst of claims is handled at once
+    wakeup_delay = 0.05
+    # When the advised pool has no member UP, run the query on a larger
+    # pool instead: 'never', 'idle' (right away if that one has an idle
+    # member) or a number of milliseconds to wait for the advised pool.
+    spillover = 'never'
+    # When a query needs more memory than any member has, change the
+    # instance type of a stopped or idle member instead of running it on
+    # one that is too small.
+    allow_resize = False
+
+    def __init__(self, pools, specs, explainer_connector, minion_connector, storage_snapshot=None, memory_model=None, instance_states=None, autoscale_policies={}, admission={}, result_cache=None):
         self._poller_thread = threading.Thread(target=self._polling_loop)
+        self._storage_thread = threading.Thread(target=self._storage_loop)
         self._pools = pools
         self._specs = specs
-        self._triggers = defaultdict(lambda: 0)
-        self._pool_condition = threading.Condition()
-        self._pool_condition_sleepers = 0
-        self._storage_lock = threading.Lock()
-        self._storage_do_not_use_directly = None
+        # minions.InstanceStateCache shared by the minions of all pools
+        self._instance_states = instance_states
+        self._autoscale_policies = dict(
+            (name, autoscale_policies.get(name) or autoscale.ReactivePolicy())
+            for name in pools.keys())
+        # options for admission.AdmissionQueue, except deadline which is
+        # the default number of seconds a query may wait for a pool
+        admission = dict(admission)
+        self.queue_deadline = admission.pop('deadline', None)
+        self._queues = dict(
+            (name, AdmissionQueue(name, p.claim, **admission))
+            for name, p in pools.items())
+        # (from pool, to pool) -> number of queries
+        self._spilled = defaultdict(int)
+        # members resized to fit a query
+        self._resized = 0
+        # set to make the polling loop go round right away
+        self._wakeup = threading.Event()
+        # Replaced as a whole by the storage thread, never modified in place
+        self._storage = None
+        self._storage_ready = threading.Event()
+        self._storage_wanted = False
+        self._storage_snapshot = storage_snapshot
         self._explainer_connector = explainer_connector
+        self._plan_cache = teiresias.PlanCache()
+        self._history = teiresias.History()
+        # results of read-only queries, None if we don't cache them
+        self._results = None if result_cache is None else ResultCache(**result_cache)
+        # (database, normalized query) -> Flight of the read-only queries
+        # being executed
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        # queries that got the result of another one
+        self._coalesced = 0
+        # cleared when the minions turn out not to support it
+        self._probe_peak_memory = True
+        self._explainers = ExplainerPool(
+            explainer_connector, self._plan_cache, memory_model, self._history)
         self._minion_connector = minion_connector
+        self._connections = connections.ConnectionPool()
         self._statushub = PollHub({})
         assert len(pools) > 0
         assert set(specs.keys()) == set(pools.keys())
 
+        for p in pools.values():
+            p.add_listener(self._member_state_changed)
+            p.add_activity_listener(lambda pool: self._wakeup.set())
+            p.add_release_listener(lambda pool: self._queues[pool.name].dispatch())
+
+        if storage_snapshot:
+            storage = teiresias.load_storage(storage_snapshot, self._database)
+            if storage:
+                print(f"Loaded storage stats for {storage.count()} columns from {storage_snapshot}")
+                self._storage = storage
+                self._storage_ready.set()
+
         self._update_status()
         self._poller_thread.daemon = True
         self._poller_thread.start()
+        self._storage_thread.daemon = True
+        self._storage_thread.start()
 
     def _polling_loop(self):
         msgs = dict((name, None) for name in self._pools.keys())
+        interval = self.poll_interval
+        last_refresh = 0
         while 1:
-            time.sleep(1)
-            wake_them = False
+            if self._wakeup.wait(interval):
+                time.sleep(self.wakeup_delay)
+            self._wakeup.clear()
+            # Being woken up by a claim is no reason to bother EC2
+            now = time.time()
+            if self._instance_states and now - last_refresh >= interval:
+                self._instance_states.refresh()
+                last_refresh = now
             for name, p in self._pools.items():
-                p.poll()
-                self._manage_pool_size(p)
+                try:
+                    p.poll()
+                    self._manage_pool_size(p)
+                except Exception as e:
+                    # keep going, the queues of the other pools depend on it
+                    print(f"Could not poll pool {name}: {e}")
                 msg = f"Pool {name}: {len(p.members())} members, {p.actual} up, {p.desired} desired, load {p.loadaverage.load:.1f}"
                 if msgs[name] != msg:
                     print(msg)
-                    wake_them = True
                 msgs[name] = msg
-            if wake_them:
-                #print()
-                with self._pool_condition:
-                    self._pool_condition.notify_all()
+                # members may have come up
+                self._queues[name].dispatch()
+            self._connections.evict_idle()
             self._update_status()
 
+            if any(p.transitional() for p in self._pools.values()):
+                interval = self.poll_interval
+            else:
+                interval = min(2 * interval, self.max_poll_interval)
+
     def _manage_pool_size(self, p):
-        loadavg = p.loadaverage
-        load = loadavg.load
-        ups = len(p.classify()['UP'])
-
-        # Ground rule: desired is load, rounded upward.
-        new_desired = int(math.ceil(load))
-        reason = "load"
-
-        # On start, load==0. We don't want to immediately shut down all minions.
-        bottom = max(0, int(ups - math.floor(loadavg.time_running / 60)))
-        if new_desired < bottom:
-            new_desired = bottom
-            reason = "keep some running initially"
-
-        # ceil(load) will never be 0.0 once load has been > 0.
-        # This means that new_desired will stay >= 0 forever.
-        # At some point we have to shut down the last minion.
-        if bottom == 0 and new_desired == 1 and loadavg.time_since_change > 15 * 60 and load < 0.1:
-            new_desired = 0
-            reason = "no recent activity"
-
-        if new_desired == 0 and self._triggers[p.name] > 0:
-            new_desired = 1
-            reason = "triggered"
-
-        new_desired = min(new_desired, len(p.members()))
+        policy = self._autoscale_policies[p.name]
+        new_desired, reason = autoscale.decide(
+            policy, time.time(), p.loadaverage, p.count('UP'), len(p.members()), self._queues[p.name].depth)
         if new_desired != p.desired:
             print(
-                f"Pool {p.name} load {load:.1f} desired {p.desired} -> {new_desired} ({reason})")
+                f"Pool {p.name} load {p.loadaverage.load:.1f} desired {p.desired} -> {new_desired} ({reason})")
 
         p.desired = new_desired
 
+    @property
+    def _database(self):
+        return self._minion_connector.parsed().path[1:]
+
     def _connector_for_ip(self, ip):
         parsed = self._minion_connector.parsed()
         netloc = parsed.netloc
@@ -100,6 +167,24 @@ class Backend:
         connector = self._minion_connector.override(netloc=netloc)
         return connector
 
+    def _connection_for_claim(self, claim):
+        """Borrow a pooled connection to the claimed minion.
+
+        Use as a context manager. The connection goes back to the pool
+        when the block exits normally.
+        """
+        connector = self._connector_for_ip(claim.ip)
+        key = (claim.name, claim.ip, claim.generation)
+        return self._connections.connection(key, connector)
+
+    def _member_state_changed(self, pool, name, state):
+        # Called with the pool lock held, discard leaves closing the
+        # connections to the polling loop.
+        # Once a minion is no longer UP its connections are of no use
+        # anymore, and after a restart they would be broken anyway.
+        if state != 'UP':
+            self._connections.discard(lambda key: key[0] == name)
+
     def status(self, id=None, seen=0):
         return self._statushub.get_state(id, seen)
 
@@ -109,12 +194,16 @@ class Backend:
         stats = {}
         for pool in self._pools.values():
             may_shrink = ", postponing shrinks" if pool.postpone_shrink else ""
+            averages = pool.loadaverage.averages()
             print(
-                f"Pool {pool.name}, load={pool.loadaverage.load:.1f}, actual={pool.actual}, desired={pool.desired}{may_shrink}:",
+                f"Pool {pool.name}, load={pool.loadaverage.load:.1f} ({'/'.join(f'{a:.1f}' for a in averages.values())}), actual={pool.actual}, desired={pool.desired}{may_shrink}:",
                 file=out)
+            reserved = pool.reserved()
             for i, (name, state, claims, minion) in enumerate(pool.members()):
                 print(f"{i+1:2d} {name} state={state}",
                       file=out, end="")
+                if reserved[name]:
+                    print(f" reserved={reserved[name] / 1024 / 1024:.0f}MiB", file=out, end="")
                 observed = minion.observed_state
                 desired = minion.desired_state
                 if observed == desired:
@@ -127,15 +216,53 @@ class Backend:
             classification=pool.classify()
             stats[pool.name] = dict(
                 load=pool.loadaverage.load,
+                # seconds of half life -> load
+                load_averages=averages,
                 up=len(classification['UP']),
                 starting=len(classification['STARTING']),
                 actual=pool.actual,
                 desired=pool.desired,
+                waiting=self._queues[pool.name].depth,
+                reserved=sum(reserved.values()),
             )
-            status = dict(
-                stats=stats,
-                text=out.getvalue(),
-            )
+        plan_cache = self._plan_cache.stats()
+        print(
+            f"Plan cache: {plan_cache['size']} entries, {plan_cache['hits']} hits, {plan_cache['misses']} misses",
+            file=out)
+        history = self._history.stats()
+        print(
+            f"History: {history['samples']} samples of {history['queries']} queries",
+            file=out)
+        results = self._results.stats() if self._results else None
+        if results:
+            print(
+                f"Result cache: {results['size']} results, {results['bytes'] / 1024 / 1024:.1f} MiB, {results['hits']} hits, {results['misses']} misses",
+                file=out)
+        queues = dict((name, q.stats()) for name, q in self._queues.items())
+        for name, q in queues.items():
+            print(
+                f"Queue {name}: {q['depth']} waiting, oldest {q['oldest_wait']:.1f}s, mean wait {q['mean_wait']:.1f}s, p95 {q['p95_wait']:.1f}s, {q['rejected']} rejected, {q['expired']} expired",
+                file=out)
+        if self._resized:
+            print(f"Resized: {self._resized} members", file=out)
+        if self._coalesced:
+            print(f"Coalesced: {self._coalesced} queries", file=out)
+        spilled = dict((f"{a}->{b}", n) for (a, b), n in sorted(self._spilled.items()))
+        if spilled:
+            print(
+                f"Spillover: {', '.join(f'{k} {n}' for k, n in spilled.items())}",
+                file=out)
+        status = dict(
+            stats=stats,
+            plan_cache=plan_cache,
+            result_cache=results,
+            history=history,
+            spilled=spilled,
+            resized=self._resized,
+            coalesced=self._coalesced,
+            queues=queues,
+            text=out.getvalue(),
+        )
         self._statushub.set_state(status, filter=lambda s:s.get('text'))
 
     def set_pool_size(self, poolname, size):
@@ -148,113 +275,396 @@ class Backend:
             print(msg)
             raise Exception(msg)
 
-    def wait_for_pool(self, pool):
-        with self._pool_condition:
-            c = pool.claim()
+    def _enter_queue(self, pool, client, priority, deadline, footprint):
+        if deadline is None:
+            deadline = self.queue_deadline
+        w = self._queues[pool.name].enter(client, priority, deadline, footprint)
+        if not w.wait(0):
+            print(
+                f"Thread {threading.current_thread().name} waiting for pool {pool.name}")
+            # so the pool gets a minion started right away
+            self._wakeup.set()
+        return w
+
+    def wait_for_pool(self, pool, timeout=None, client=None, priority=0, deadline=None, footprint=None):
+        """Claim a member of pool, waiting in its admission queue if needed.
+
+        Returns None if that takes more than timeout seconds. Raises
+        admission.Rejected if the queue is full or the query is still
+        waiting after deadline seconds. With a footprint in bytes the
+        claim goes to a member with that much memory to spare, see
+        Pool.claim.
+        """
+        w = self._enter_queue(pool, client, priority, deadline, footprint)
+        c = w.wait(timeout)
+        if not c:
+            w.cancel()
+        return c
+
+    def _current_specs(self):
+        # Members can be resized so ask the pools, the specs we were
+        # given are for pools whose members don't know their memory
+        specs = {}
+        for name, p in self._pools.items():
+            specs[name] = p.memory() or self._specs[name]
+        return specs
+
+    def _larger_pools(self, name):
+        specs = self._current_specs()
+        mem = specs[name]
+        larger = [n for n in self._pools if specs[n] > mem]
+        return [self._pools[n] for n in sorted(larger, key=lambda n: specs[n])]
+
+    def _make_room(self, needed, specs):
+        # Resize a member to the smallest instance type that fits and
+        # return the name of its pool, or None
+        fitting = sorted(
+            (mib, itype) for itype, mib in INSTANCE_TYPE_MEMORY_MiB.items()
+            if mib * 1024 * 1024 > needed)
+        if not fitting:
+            return None
+        _, itype = fitting[0]
+        # the pool with the largest members is most likely meant for this
+        for name in sorted(self._pools, key=lambda n: specs[n], reverse=True):
+            member = self._pools[name].resize(itype)
+            if member:
+                print(f"Resizing {member} of pool {name} to {itype} for a query needing {needed / 1024 / 1024:.0f} MiB")
+                self._resized += 1
+                return name
+        return None
+
+    def _advise(self, q):
+        storage = self.get_storage()
+        specs = self._current_specs()
+        adv, needed = self._explainers.advise(q, storage, specs)
+        if self.allow_resize and needed >= specs[adv]:
+            # nothing fits
+            adv = self._make_room(needed, specs) or adv
+        return adv, needed
+
+    def _spill(self, name, idle_only, footprint):
+        for p in self._larger_pools(name):
+            c = p.claim(idle_only, footprint)
             if c:
+                self._spilled[(name, p.name)] += 1
+                # so pool name still scales up for its queries
+                self._pools[name].carry(c)
+                print(f"Spilling query from pool {name} to {p.name}")
                 return c
+        return None
 
-            if self._pool_condition_sleepers >= 100:
-                raise Exception("too busy")
-            try:
-                self._pool_condition_sleepers += 1
-                self._triggers[pool.name] += 1
-                print(
-                    f"Thread {threading.current_thread().name} waiting for pool {pool.name}")
-                while 1:
-                    c = pool.claim()
-                    if c:
-                        print(
-                            f"Thread {threading.current_thread().name} proceeding with pool {pool.name}")
-                        return c
-                    self._pool_condition.wait()
-            finally:
-                self._pool_condition_sleepers -= 1
-                self._triggers[pool.name] -= 1
-
-    def claim_any_pool(self):
+    def claim_for_advice(self, adv, client=None, priority=0, deadline=None, footprint=None):
+        """Claim a member of pool adv or, following the spillover policy,
+        of a pool with more memory. See wait_for_pool."""
+        p = self._pools[adv]
+        spillover = self.spillover
+        if spillover == 'never' or not self._larger_pools(adv):
+            return self.wait_for_pool(p, None, client, priority, deadline, footprint)
+        # keep our place in the queue while looking elsewhere
+        w = self._enter_queue(p, client, priority, deadline, footprint)
+        if spillover == 'idle':
+            c = w.wait(0) or self._spill(adv, True, footprint)
+        else:
+            c = w.wait(spillover / 1000) or self._spill(adv, False, footprint)
+        if c:
+            if c.pool_name != adv:
+                w.cancel()
+            return c
+        return w.wait()
+
+    def _claim_up_minion(self, background=False):
         for p in self._pools.values():
-            c = p.claim()
+            c = p.claim(background=background)
             if c:
                 return c
+        return None
+
+    def claim_any_pool(self):
+        c = self._claim_up_minion()
+        if c:
+            return c
 
         first_pool = list(self._pools.values())[0]
         return self.wait_for_pool(first_pool)
 
     def get_storage(self):
-        with self._storage_lock:
-            if not self._storage_do_not_use_directly:
-                with self.claim_any_pool() as claim:
-                    connector = self._connector_for_ip(claim.ip)
-                    conn = connector.connect()
-                    try:
-                        storage = teiresias.get_storage(conn)
-                        self._storage_do_not_use_directly = storage
-                        print("Succesfully retrieved storage stats")
-                    finally:
-                        conn.close()
-            return self._storage_do_not_use_directly
-
-    def execute_query(self, q):
-        # Not sure if connection is thread safe, better create new one.
-        # Future work: connection pool
-
-        # First get some advice
-        storage = self.get_storage()
-        conn = self._explainer_connector.connect()
+        storage = self._storage
+        if storage is None:
+            # only happens until the first stats have been retrieved
+            self._storage_wanted = True
+            self._storage_ready.wait()
+            storage = self._storage
+        return storage
+
+    def _storage_loop(self):
+        # Stats loaded from a snapshot are first checked incrementally
+        refreshes = 0 if self._storage is None else 1
+        while 1:
+            # Only start a minion for this if someone needs the stats
+            # and we have none at all. Refreshing is no reason to keep
+            # a minion running so it doesn't count as load.
+            claim = self._claim_up_minion(background=True)
+            if not claim and self._storage is None and self._storage_wanted:
+                try:
+                    claim = self.claim_any_pool()
+                except Rejected as e:
+                    # queue full or we waited too long, get_storage()
+                    # callers are still waiting so try again
+                    print(f"Could not claim a minion for storage stats: {e}")
+            if claim:
+                full = refreshes % self.storage_full_refresh == 0
+                try:
+                    with claim:
+                        self._refresh_storage(claim, full)
+                    refreshes += 1
+                except Exception as e:
+                    print(f"Could not retrieve storage stats: {e}")
+
+            if self._storage is None:
+                time.sleep(1)
+            else:
+                time.sleep(self.storage_refresh_interval)
+
+    def _refresh_storage(self, claim, full):
+        old = self._storage
+        with self._connection_for_claim(claim) as conn:
+            if old is None or full:
+                storage = teiresias.get_storage(conn)
+            else:
+                storage = teiresias.refresh_storage(conn, old)
+        if old is None or storage != old:
+            self._storage = storage
+            self._storage_ready.set()
+            print(f"Succesfully retrieved storage stats ({storage.count()} columns)")
+            if old is not None and self._results:
+                # something changed, maybe the data of a cached result
+                self._results.clear()
+            if self._storage_snapshot:
+                try:
+                    teiresias.save_storage(storage, self._storage_snapshot, self._database)
+                except OSError as e:
+                    print(f"Could not save storage snapshot: {e}")
+
+    def _result_key(self, kind, q):
+        # None if the result of q may not be cached
+        if self._results is None or not teiresias.is_read_only(q):
+            return None
+        return (self._database, kind, teiresias.normalize(q))
+
+    def invalidate_results(self):
+        """Forget all cached results, return how many there were"""
+        if self._results is None:
+            return 0
+        n = self._results.clear()
+        print(f"Dropped {n} cached results")
+        return n
+
+    def execute_query(self, q, client=None, priority=0, deadline=None):
+        """Run q on a minion of the advised pool.
+
+        client, priority and deadline determine its place in the pool's
+        admission queue, see AdmissionQueue. A cached result doesn't
+        need a minion at all. Read-only queries that arrive while the
+        same query is running get the result of that one, see Flight.
+        """
+        key = self._result_key('execute', q)
+        if key:
+            cached = self._results.get(key)
+            if cached:
+                return dict(cached, query=q, cached=True)
+
+        # The same query may be running already, then its result will do
+        flight_key = (self._database, teiresias.normalize(q)) if teiresias.is_read_only(q) else None
+        if flight_key is None:
+            return self._execute(q, client, priority, deadline, key)
+        until = None if deadline is None else time.time() + deadline
+        while True:
+            with self._flights_lock:
+                flight = self._flights.get(flight_key)
+                leading = flight is None
+                if leading:
+                    flight = self._flights[flight_key] = Flight()
+                else:
+                    self._coalesced += 1
+            if leading:
+                break
+            result = flight.wait(None if until is None else until - time.time())
+            if result is not None:
+                return dict(result, query=q, coalesced=True)
+            # the leader didn't get a minion, our own deadline may allow it
+        if until is not None:
+            deadline = until - time.time()
         try:
-            adviser = teiresias.Adviser(conn, storage)
-            adv = adviser.advise(q, self._specs)
+            flight.result = self._execute(q, client, priority, deadline, key)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
         finally:
-            conn.close()
+            with self._flights_lock:
+                del self._flights[flight_key]
+            flight.done.set()
 
-        # Then send the query to the recommended pool
-        p = self._pools[adv]
+    def _execute(self, q, client, priority, deadline, key):
+        # First get some advice
+        adv, needed = self._advise(q)
 
-        with self.wait_for_pool(p) as claim:
-            connector = self._connector_for_ip(claim.ip)
-            conn = connector.connect()
-            try:
+        # Then send the query to a member of the recommended pool, or a
+        # larger one, with room for it
+        with self.claim_for_advice(adv, client, priority, deadline, needed) as claim:
+            with self._connection_for_claim(claim) as conn:
                 cursor = conn.cursor()
+                t0 = time.time()
                 rows = cursor.execute(q)
-                return dict(
+                duration = time.time() - t0
+                peak = self._peak_memory(conn)
+                self._history.record(teiresias.fingerprint(q), duration, rows, peak)
+                result = dict(
                     query=q,
                     advice=adv,
+                    pool=claim.pool_name,
                     ip=claim.ip,
-                    url=connector.url,
+                    url=self._connector_for_ip(claim.ip).url,
                     rows=rows,
+                    duration=duration,
+                    peak_memory=peak,
                 )
-            finally:
-                conn.close()
-
-
-INSTANCE_TYPE_MEMORY_MiB = {
-    "t2.micro": 1024,
-    "t2.small": 2048,
-    "t2.medium": 4096,
-    "t2.large": 8192,
-    "t2.xlarge": 16384,
-}
+        if key:
+            self._results.put(key, result)
+        return result
+
+    def stream_query(self, q, batch_size=1000, client=None, priority=0, deadline=None):
+        """Run q and produce its result incrementally.
+
+        This is a generator. It first yields a dict describing the query
+        and its result columns, then lists of at most batch_size rows.
+        The minion stays claimed until the generator is exhausted or
+        closed, so close it when giving up halfway. Cached results come
+        without claiming a minion.
+        """
+        key = self._result_key('stream', q)
+        if key:
+            cached = self._results.get(key)
+            if cached:
+                header, all_rows = cached
+                yield dict(header, query=q, cached=True)
+                for i in range(0, len(all_rows), batch_size):
+                    yield all_rows[i:i + batch_size]
+                return
 
+        adv, needed = self._advise(q)
 
-def make_backend(explainer_connector, minion_connector_template, filters):
+        with self.claim_for_advice(adv, client, priority, deadline, needed) as claim:
+            with self._connection_for_claim(claim) as conn:
+                cursor = conn.cursor()
+                # pymonetdb fetches arraysize rows per round trip and only
+                # keeps the current block
+                cursor.arraysize = batch_size
+                t0 = time.time()
+                cursor.execute(q)
+                columns = [d[0] for d in cursor.description or []]
+                header = dict(
+                    query=q,
+                    advice=adv,
+                    pool=claim.pool_name,
+                    ip=claim.ip,
+                    columns=columns,
+                )
+                yield header
+                rows = 0
+                # what we keep for the cache, None once it's too big
+                kept = [] if key else None
+                size = result_size(header)
+                while columns:
+                    batch = cursor.fetchmany(batch_size)
+                    if not batch:
+                        break
+                    rows += len(batch)
+                    if kept is not None:
+                        size += result_size(batch)
+                        if size > self._results.max_bytes / 10:
+                            kept = None
+                        else:
+                            kept.extend(batch)
+                    yield batch
+                cursor.close()
+                duration = time.time() - t0
+                peak = self._peak_memory(conn)
+                self._history.record(teiresias.fingerprint(q), duration, rows, peak)
+        if kept is not None:
+            self._results.put(key, (header, kept), size)
+
+    def _peak_memory(self, conn):
+        if not self._probe_peak_memory:
+            return None
+        try:
+            return teiresias.peak_memory(conn)
+        except NotImplementedError as e:
+            print(f"Minions can't report peak memory, not asking again: {e}")
+            self._probe_peak_memory = False
+        except Exception as e:
+            print(f"Could not get peak memory: {e}")
+        # the result of the query itself is in already
+        connections.rollback_quietly(conn)
+        return None
+
+
+INSTANCE_TYPE_MEMORY_MiB = minions.INSTANCE_TYPE_MEMORY_MiB
+
+
+def make_backend(explainer_connector, minion_connector_template, filters, storage_snapshot=None, memory_model=None, claim_strategies={}, autoscale_policies={}, spillover='never', admission={}, allow_resize=False, weigh_load=False, result_cache=None):
+    """claim_strategies maps pool names to a key of pool.STRATEGIES,
+    pools not mentioned pick members at random. autoscale_policies maps
+    pool names to a key of autoscale.POLICIES, the default is reactive.
+    spillover is 'never', 'idle' or a number of milliseconds, see
+    Backend.spillover, allow_resize enables Backend.allow_resize and
+    weigh_load Pool.weigh_load.
+    admission holds the max_depth, ordering and fair
+    options of the admission queues and the default deadline. With
+    result_cache, a dict of ResultCache options, the results of read-only
+    queries are cached."""
+    if spillover not in ('never', 'idle'):
+        try:
+            spillover = int(spillover)
+        except ValueError:
+            spillover = -1
+        if spillover < 0:
+            raise Exception(
+                "Spillover must be 'never', 'idle' or a number of milliseconds")
     pools = {}
     specs = {}
+    policies = {}
+    instance_states = minions.InstanceStateCache(ec2)
     for name, filter in filters.items():
-        ms = minions.track_down_minions(ec2, filter)
+        ms = minions.track_down_minions(ec2, filter, instance_states)
         if not ms:
             raise Exception(f"Found no {name} minions using filter {filter}")
-        example = ms[0]
-        instance_type = example.instance.instance_type
-        mem = INSTANCE_TYPE_MEMORY_MiB.get(instance_type)
-        if not mem:
+        # members may differ, each claim is checked against the member
+        # that gets it
+        for m in ms:
+            if not m.memory:
+                raise Exception(
+                    f"Don't know how much memory a {m.instance_type} has")
+        strategy_name = claim_strategies.get(name, 'random')
+        strategy = pool.STRATEGIES.get(strategy_name)
+        if not strategy:
             raise Exception(
-                f"Don't know how much memory a {instance_type} has")
-        p = pool.Pool(name, ms)
+                f"Unknown claim strategy {strategy_name}, try one of {', '.join(pool.STRATEGIES.keys())}")
+        p = pool.Pool(name, ms, strategy())
+        p.weigh_load = weigh_load
         pools[name] = p
-        specs[name] = mem * 1024 * 1024 * 1.0
+        policy_name = autoscale_policies.get(name, 'reactive')
+        policy = autoscale.POLICIES.get(policy_name)
+        if not policy:
+            raise Exception(
+                f"Unknown autoscale policy {policy_name}, try one of {', '.join(autoscale.POLICIES.keys())}")
+        policies[name] = policy()
+        specs[name] = p.memory() * 1.0
 
-    return Backend(pools, specs, explainer_connector, minion_connector_template)
+    backend = Backend(pools, specs, explainer_connector, minion_connector_template, storage_snapshot, memory_model, instance_states, policies, admission, result_cache)
+    backend.spillover = spillover
+    backend.allow_resize = allow_resize
+    return backend
 
 
 class Connector:
@@ -297,6 +707,96 @@ class Connector:
         return self.connect()
 
 
+class ExplainerPool:
+    """A bounded set of long-lived connections to the explainer database,
+    each with its own Adviser.
+
+    At most size EXPLAINs run concurrently, other callers wait for a
+    connection to come free.
+    """
+
+    def __init__(self, connector, plan_cache=None, model=None, history=None, size=4):
+        self._connector = connector
+        self._plan_cache = plan_cache
+        self._model = model
+        self._history = history
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _new_adviser(self, storage):
+        conn = self._connector.connect()
+        # nothing we do here needs a transaction and this way a failed
+        # EXPLAIN doesn't leave the connection in an aborted transaction
+        conn.set_autocommit(True)
+        return teiresias.Adviser(conn, storage, self._plan_cache, self._model, self._history)
+
+    def _take(self, storage):
+        with self._lock:
+            adviser = self._idle.pop() if self._idle else None
+        if adviser:
+            adviser.storage = storage
+        else:
+            adviser = self._new_adviser(storage)
+        return adviser
+
+    def _put(self, adviser):
+        with self._lock:
+            self._idle.append(adviser)
+
+    def advise(self, query, storage, specs):
+        """Return the name of the machine in specs that query should
+        run on and the number of bytes it is expected to need."""
+        with self._slots:
+            adviser = self._take(storage)
+            try:
+                needed = adviser.required_memory(query)
+            except Exception:
+                # Either the query is bad or the connection died.
+                if connections.is_healthy(adviser.conn):
+                    self._put(adviser)
+                    raise
+                connections.close_quietly(adviser.conn)
+                print("Lost connection to explainer, reconnecting")
+                adviser = self._new_adviser(storage)
+                try:
+                    needed = adviser.required_memory(query)
+                except Exception:
+                    if connections.is_healthy(adviser.conn):
+                        self._put(adviser)
+                    else:
+                        connections.close_quietly(adviser.conn)
+                    raise
+            self._put(adviser)
+            return teiresias.pick_machine(needed, specs), needed
+
+
+class Flight:
+    """A query in progress whose result other callers are waiting for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self, timeout=None):
+        """Return the result, or raise what the query raised.
+
+        Returns None if the query was rejected by the admission queue,
+        whose deadline isn't the caller's. Raises Rejected after timeout
+        seconds.
+        """
+        if timeout is not None:
+            timeout = max(0, timeout)
+        if not self.done.wait(timeout):
+            raise Rejected(f"Waited more than {timeout:.1f}s for the same query")
+        if isinstance(self.error, Rejected):
+            return None
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
 class PollHub:
     def __init__(self, initial_state):
         self._last_update = 0
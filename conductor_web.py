@@ -1,11 +1,15 @@
 
 import cgi
+import csv
+import io
 import json
 import mimetypes
 import os
 import urllib
 from http.server import BaseHTTPRequestHandler
 
+import admission
+
 
 class ClientError(Exception):
     """Exception indicating that the client did something wrong."""
@@ -158,20 +162,46 @@ class ConductorRequestHandler(BaseHTTPRequestHandler):
         if path == '/query/':
             self.handle_query()
             return
+        elif path == '/query/stream/':
+            self.handle_query_stream()
         elif path == '/poolsize/':
             self.handle_poolsize()
+        elif path == '/cache/invalidate/':
+            self.handle_invalidate()
         elif path == '/status/':
             self.handle_post_status()
         else:
             raise ClientError(404, "No such endpoint: " + path)
 
+    def queueing_parms(self, parms):
+        """Return the client, priority and deadline parameters.
+
+        client defaults to the address the request came from.
+        """
+        client = parms.get('client') or self.client_address[0]
+        try:
+            priority = int(parms.get('priority', 0))
+        except ValueError:
+            raise ClientError(400, "Parameter 'priority' must be numeric")
+        deadline = parms.get('deadline')
+        if deadline is not None:
+            try:
+                deadline = float(deadline)
+            except ValueError:
+                raise ClientError(400, "Parameter 'deadline' must be numeric")
+        return client, priority, deadline
+
     def handle_query(self):
         parms = self.getparms()
         query = parms.get('query')
         if not query:
             raise ClientError(400, "Must provide query")
 
-        result = self.server.backend.execute_query(query)
+        client, priority, deadline = self.queueing_parms(parms)
+        try:
+            result = self.server.backend.execute_query(query, client, priority, deadline)
+        except admission.Rejected as e:
+            raise ClientError(503, str(e))
 
         resp = json.dumps(result, indent=4)
         self.send_response(200)
@@ -180,6 +210,67 @@ class ConductorRequestHandler(BaseHTTPRequestHandler):
         self.wfile.write(bytes(resp, 'utf-8'))
         self.wfile.write(b"\n")
 
+    def handle_query_stream(self):
+        """Like handle_query but sends the result rows, as NDJSON or CSV,
+        while they are being fetched from the minion."""
+        parms = self.getparms()
+        query = parms.get('query')
+        if not query:
+            raise ClientError(400, "Must provide query")
+        fmt = parms.get('format', 'ndjson')
+        if fmt not in ['ndjson', 'csv']:
+            raise ClientError(400, "format must be ndjson or csv")
+        try:
+            batch_size = int(parms.get('batch', 1000))
+        except ValueError:
+            raise ClientError(400, "Parameter 'batch' must be numeric")
+        if batch_size < 1:
+            raise ClientError(400, "batch must be >= 1")
+
+        client, priority, deadline = self.queueing_parms(parms)
+
+        stream = self.server.backend.stream_query(query, batch_size, client, priority, deadline)
+        try:
+            # Advice, claim and execution happen here, so errors can
+            # still become a proper error response
+            try:
+                header = next(stream)
+            except admission.Rejected as e:
+                raise ClientError(503, str(e))
+
+            self.send_response(200)
+            if fmt == 'ndjson':
+                self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+            else:
+                self.send_header('Content-Type', 'text/csv; charset=utf-8')
+            # no Content-Length, the response ends when the connection does
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+
+            out = io.StringIO()
+            if fmt == 'ndjson':
+                out.write(json.dumps(header, default=str))
+                out.write("\n")
+            else:
+                writer = csv.writer(out)
+                writer.writerow(header['columns'])
+            for batch in stream:
+                if fmt == 'ndjson':
+                    for row in batch:
+                        out.write(json.dumps(row, default=str))
+                        out.write("\n")
+                else:
+                    writer.writerows(batch)
+                self.wfile.write(bytes(out.getvalue(), 'utf-8'))
+                self.wfile.flush()
+                out.seek(0)
+                out.truncate()
+            self.wfile.write(bytes(out.getvalue(), 'utf-8'))
+        finally:
+            # releases the claim if we stopped early
+            stream.close()
+
     def handle_poolsize(self):
         parms = self.getparms()
         for poolname, size in parms.items():
@@ -196,6 +287,13 @@ class ConductorRequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(b"OK\n")
 
+    def handle_invalidate(self):
+        n = self.server.backend.invalidate_results()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.end_headers()
+        self.wfile.write(bytes(f"OK, dropped {n} results\n", 'utf-8'))
+
     def handle_get_status(self):
         id, seen, status = self.server.backend.status()
         self.send_response(200)
@@ -0,0 +1,165 @@
+#
+
+from contextlib import contextmanager
+import threading
+import time
+
+
+class _Slot:
+    """The idle connections for one key, plus bookkeeping."""
+
+    def __init__(self):
+        self.idle = []          # list of (conn, last_used)
+        self.borrowed = 0
+        self.discarded = False
+
+
+class ConnectionPool:
+    """Keeps idle MAPI connections around so the next claim on the same
+    minion does not have to go through the whole handshake again.
+
+    Connections are grouped by key. The backend uses (member name, ip,
+    claim generation) so a connection never survives a restart of the
+    minion it was made to. Use discard() to get rid of the connections
+    of a minion that is going away.
+    """
+
+    def __init__(self, max_idle_time=60, max_idle_per_key=8, check_after=10):
+        self._lock = threading.Lock()
+        self._slots = {}
+        # idle connections of discarded keys, closed by evict_idle
+        self._doomed = []
+        self.max_idle_time = max_idle_time
+        self.max_idle_per_key = max_idle_per_key
+        # connections that have been idle longer than this get a quick
+        # SELECT 1 before they're handed out
+        self.check_after = check_after
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def connection(self, key, connector):
+        """Borrow a connection for key, creating one with connector() if
+        there is no usable idle connection.
+
+        The connection is returned to the pool when the with-block exits
+        normally and closed when it raises.
+        """
+        slot, conn = self._borrow(key, connector)
+        ok = False
+        try:
+            yield conn
+            ok = True
+        finally:
+            self._return(slot, conn, ok)
+
+    def _borrow(self, key, connector):
+        now = time.time()
+        while True:
+            with self._lock:
+                slot = self._slots.get(key)
+                if not slot:
+                    slot = _Slot()
+                    self._slots[key] = slot
+                if not slot.idle:
+                    slot.borrowed += 1
+                    self.misses += 1
+                    break
+                conn, last_used = slot.idle.pop()
+                slot.borrowed += 1
+            idle = now - last_used
+            if idle < self.max_idle_time and (idle < self.check_after or is_healthy(conn)):
+                with self._lock:
+                    self.hits += 1
+                return slot, conn
+            # stale or broken, try the next one
+            close_quietly(conn)
+            with self._lock:
+                slot.borrowed -= 1
+
+        try:
+            conn = connector()
+        except:
+            with self._lock:
+                slot.borrowed -= 1
+            raise
+        return slot, conn
+
+    def _return(self, slot, conn, ok):
+        if ok:
+            # don't leave a transaction open for the next borrower
+            try:
+                conn.rollback()
+            except Exception:
+                ok = False
+        with self._lock:
+            slot.borrowed -= 1
+            keep = ok and not slot.discarded and len(slot.idle) < self.max_idle_per_key
+            if keep:
+                slot.idle.append((conn, time.time()))
+        if not keep:
+            close_quietly(conn)
+
+    def discard(self, predicate):
+        """Stop handing out the connections of all keys for which
+        predicate(key) holds.
+
+        This doesn't talk to the network so it can be called with other
+        locks held. The idle connections are closed by the next
+        evict_idle, the borrowed ones when they are returned.
+        """
+        with self._lock:
+            for key in [k for k in self._slots if predicate(k)]:
+                slot = self._slots.pop(key)
+                slot.discarded = True
+                self._doomed.extend(conn for conn, _ in slot.idle)
+                slot.idle = []
+
+    def evict_idle(self):
+        """Close connections that have been idle for longer than
+        max_idle_time and those of discarded keys"""
+        cutoff = time.time() - self.max_idle_time
+        with self._lock:
+            doomed, self._doomed = self._doomed, []
+            for key, slot in list(self._slots.items()):
+                fresh = [(c, t) for c, t in slot.idle if t >= cutoff]
+                doomed.extend(c for c, t in slot.idle if t < cutoff)
+                slot.idle = fresh
+                if not fresh and not slot.borrowed:
+                    del self._slots[key]
+        for conn in doomed:
+            close_quietly(conn)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                idle=sum(len(s.idle) for s in self._slots.values()),
+                borrowed=sum(s.borrowed for s in self._slots.values()),
+                hits=self.hits,
+                misses=self.misses,
+            )
+
+
+def is_healthy(conn):
+    try:
+        c = conn.cursor()
+        c.execute('SELECT 1')
+        c.fetchall()
+        c.close()
+        return True
+    except Exception:
+        return False
+
+
+def close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def rollback_quietly(conn):
+    try:
+        conn.rollback()
+    except Exception:
+        pass
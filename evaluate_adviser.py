@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Replay recorded plans through the Adviser's sizing rules and report
+# how often each of them picks the right machine.
+#
+# Usage: evaluate_adviser.py SNAPSHOT DATABASE RECORDINGS [NAME=MiB ...]
+#
+# SNAPSHOT is a storage snapshot as written by the conductor (see
+# teiresias.save_storage), DATABASE the database it belongs to.
+# RECORDINGS has one JSON object per line:
+#
+#   {"query": "SELECT ...", "plan": ["...", ...], "peak_memory": 123456}
+#
+# where plan holds the rows EXPLAIN returned. Instead of peak_memory,
+# the object can name the right machine directly with "machine": "SMALL".
+# The machines default to SMALL=2048 and LARGE=8192.
+
+import json
+import sys
+
+import malplan
+import teiresias
+
+
+def load_recordings(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def column_sum(summary, storage):
+    # what the Adviser does without a MemoryModel
+    return storage.total_size(summary.columns) * 2
+
+
+def evaluate(recordings, storage, specs, rules):
+    order = dict((m, i) for i, m in enumerate(sorted(specs, key=lambda m: (specs[m], m))))
+    results = dict((name, dict(right=0, too_small=0, too_large=0, skipped=0)) for name in rules)
+    for rec in recordings:
+        if 'machine' in rec:
+            truth = rec['machine']
+        elif 'peak_memory' in rec:
+            truth = teiresias.pick_machine(rec['peak_memory'], specs)
+        else:
+            continue
+        summary = malplan.summarize(rec['plan'])
+        for name, rule in rules.items():
+            counts = results[name]
+            try:
+                needed = rule(summary, storage)
+            except KeyError:
+                # plan refers to columns the snapshot doesn't know
+                counts['skipped'] += 1
+                continue
+            advice = teiresias.pick_machine(needed, specs)
+            if advice == truth:
+                counts['right'] += 1
+            elif order[advice] < order[truth]:
+                counts['too_small'] += 1
+            else:
+                counts['too_large'] += 1
+    return results
+
+
+def main(args):
+    if len(args) < 3:
+        print(f"Usage: {sys.argv[0]} SNAPSHOT DATABASE RECORDINGS [NAME=MiB ...]", file=sys.stderr)
+        sys.exit(1)
+    snapshot, database, recordings = args[:3]
+    specs = {}
+    for spec in args[3:] or ['SMALL=2048', 'LARGE=8192']:
+        name, mib = spec.split('=')
+        specs[name] = int(mib) * 1024 * 1024
+
+    storage = teiresias.load_storage(snapshot, database)
+    if not storage:
+        print(f"No usable snapshot for {database} in {snapshot}", file=sys.stderr)
+        sys.exit(1)
+
+    model = teiresias.MemoryModel()
+    rules = {
+        'column sum': column_sum,
+        'memory model': model.required_memory,
+    }
+    recs = load_recordings(recordings)
+    results = evaluate(recs, storage, specs, rules)
+    print(f"{len(recs)} recordings")
+    for name, counts in results.items():
+        judged = counts['right'] + counts['too_small'] + counts['too_large']
+        accuracy = counts['right'] / judged if judged else 0
+        print(f"{name:>12}: {accuracy:6.1%} right, {counts['too_small']} too small, {counts['too_large']} too large, {counts['skipped']} skipped")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
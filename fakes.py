@@ -0,0 +1,153 @@
+#
+
+# Stand-ins for the AWS side of things so Pool and friends can be
+# exercised without a cluster.
+
+from types import SimpleNamespace
+import time
+
+from minions import READY, PENDING, RUNNING, STOPPING, STOPPED, TERMINATED
+
+
+class FakeMinion:
+    """Looks enough like a minions.Minion for Pool to manage it.
+
+    State changes take effect immediately. refresh() takes refresh_delay
+    seconds, like talking to EC2 would.
+    """
+
+    def __init__(self, name, ip=None, state=READY, refresh_delay=0):
+        self.name = name
+        self.ip = ip or name
+        self.observed_state = state
+        self.desired_state = None
+        self.refresh_delay = refresh_delay
+
+    def refresh(self):
+        if self.refresh_delay:
+            time.sleep(self.refresh_delay)
+
+    def make(self, desired_state):
+        self.desired_state = desired_state
+        return True
+
+    def resize(self, instance_type):
+        self.desired_instance_type = instance_type
+
+    def poll(self):
+        if self.desired_state:
+            self.observed_state = self.desired_state
+
+
+def fake_minions(n, prefix="minion", state=READY):
+    return [FakeMinion(f"{prefix}{i:03d}", f"10.0.{i // 256}.{i % 256}", state) for i in range(n)]
+
+
+class FakeInstance:
+    """An EC2 instance as seen through boto3's ec2.Instance(id).
+
+    start() and stop() take start_delay and stop_delay seconds of the
+    FakeEC2's clock to complete.
+    """
+
+    def __init__(self, ec2, id, name, ip, instance_type, tags, state):
+        self._ec2 = ec2
+        self.id = id
+        self.private_ip_address = ip
+        self.instance_type = instance_type
+        self.tags = [dict(Key='Name', Value=name)] + [dict(Key=k, Value=v) for k, v in tags.items()]
+        self._state = state
+        # (time, state) we're heading for
+        self._next = None
+
+    def _current(self):
+        if self._next and self._ec2.clock() >= self._next[0]:
+            self._state = self._next[1]
+            self._next = None
+        return self._state
+
+    @property
+    def state(self):
+        st = self._current()
+        return dict(Code=st.code, Name=st.name.lower())
+
+    def start(self):
+        if self._current() == STOPPED:
+            self._state = PENDING
+            self._next = (self._ec2.clock() + self._ec2.start_delay, RUNNING)
+
+    def stop(self):
+        if self._current() in (PENDING, RUNNING):
+            self._state = STOPPING
+            self._next = (self._ec2.clock() + self._ec2.stop_delay, STOPPED)
+
+    def _describe(self):
+        return dict(
+            InstanceId=self.id,
+            InstanceType=self.instance_type,
+            PrivateIpAddress=self.private_ip_address,
+            State=self.state,
+            Tags=self.tags,
+        )
+
+
+class FakeEC2:
+    """Stand-in for boto3.resource('ec2') with just enough of the resource
+    and client interfaces for minions.py.
+
+    describe_calls counts the describe_instances calls.
+    """
+
+    def __init__(self, clock=time.time, start_delay=30, stop_delay=10):
+        self.clock = clock
+        self.start_delay = start_delay
+        self.stop_delay = stop_delay
+        self.describe_calls = 0
+        self._instances = {}
+        self.instances = SimpleNamespace(filter=self._filter)
+        self.meta = SimpleNamespace(client=SimpleNamespace(
+            describe_instances=self._describe_instances,
+            modify_instance_attribute=self._modify_instance_attribute))
+
+    def add_instance(self, name, instance_type='t2.small', tags={}, state=STOPPED, ip=None):
+        n = len(self._instances)
+        id = f"i-{n:017x}"
+        ip = ip or f"10.1.{n // 256}.{n % 256}"
+        inst = FakeInstance(self, id, name, ip, instance_type, tags, state)
+        self._instances[id] = inst
+        return inst
+
+    def Instance(self, id):
+        return self._instances[id]
+
+    def _matches(self, inst, filters):
+        tags = dict((d['Key'], d['Value']) for d in inst.tags)
+        for f in filters or []:
+            name, values = f['Name'], f['Values']
+            if name == 'instance-id':
+                value = inst.id
+            elif name.startswith('tag:'):
+                value = tags.get(name[4:])
+            else:
+                raise Exception(f"FakeEC2 doesn't know filter {name}")
+            if value not in values:
+                return False
+        return True
+
+    def _filter(self, Filters=None):
+        return [i for i in self._instances.values() if self._matches(i, Filters)]
+
+    def _modify_instance_attribute(self, InstanceId, InstanceType):
+        inst = self._instances[InstanceId]
+        if inst._current() != STOPPED:
+            raise Exception(f"IncorrectInstanceState: {InstanceId} is not stopped")
+        inst.instance_type = InstanceType['Value']
+
+    def _describe_instances(self, Filters=None, InstanceIds=None, NextToken=None):
+        self.describe_calls += 1
+        found = []
+        for inst in self._filter(Filters):
+            if InstanceIds is not None and inst.id not in InstanceIds:
+                continue
+            found.append(inst._describe())
+        return dict(Reservations=[dict(Instances=found)] if found else [])
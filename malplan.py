@@ -0,0 +1,202 @@
+#
+
+from collections import namedtuple
+import re
+
+
+# bind_idxbat is what older versions call bindidx
+_KINDS = {
+    'bind': 'bind',
+    'bindidx': 'bindidx',
+    'bind_idxbat': 'bindidx',
+    'tid': 'tid',
+}
+
+# The first argument is the mvc variable, then come the schema, table and
+# column (or index) names as "..." strings with backslash escapes,
+# optionally followed by a type annotation such as :str. sql.tid only
+# has schema and table, so the third string is optional.
+_STR = r'\s*"([^"\\]*(?:\\.[^"\\]*)*)"(?::\w+)?\s*'
+_CALL = re.compile(
+    r'sql\.(bind|bindidx|bind_idxbat|tid)\([^,()"]*,' +
+    _STR + ',' + _STR + '(?:,' + _STR + ')?[,)]')
+
+_ESCAPE = re.compile(r'\\(.)')
+
+
+def plan_text(rows):
+    """Turn the rows returned by EXPLAIN into a single string.
+
+    Rows can be tuples as returned by a cursor or plain strings.
+    """
+    return '\n'.join(r if isinstance(r, str) else r[0] for r in rows)
+
+
+def _unquote(s):
+    if '\\' not in s:
+        return s
+    return _ESCAPE.sub(r'\1', s)
+
+
+def _calls(plan):
+    text = plan if isinstance(plan, str) else plan_text(plan)
+    return _CALL.findall(text)
+
+
+def bound_columns(plan):
+    """Return the set of (schema, table, column) triples bound by sql.bind"""
+    # Plans bind the same column many times, dedup before unquoting
+    triples = set(
+        (schema, table, column)
+        for kind, schema, table, column in _calls(plan)
+        if kind == 'bind' and column
+    )
+    return set(
+        (_unquote(schema), _unquote(table), _unquote(column))
+        for schema, table, column in triples
+    )
+
+
+Instruction = namedtuple('Instruction', ['results', 'module', 'function', 'args'])
+Instruction.__doc__ = """One MAL assignment such as X_3 := algebra.select(X_1, C_2, ...).
+
+results is a list of variable names. args holds variable names as str
+and everything else as Literal.
+"""
+
+Literal = namedtuple('Literal', ['value'])
+
+_ASSIGNMENT = re.compile(r'^\s*(?:(?:barrier|leave|redo|catch|raise|return)\s+)?(.*?)\s*:=\s*(\w+)\.(\w+)\((.*)\)\s*;\s*$', re.MULTILINE)
+_RESULT = re.compile(r'(?:^|[(,])\s*([A-Za-z_]\w*)')
+_PLAN_ARG = re.compile(r'\s*(?:"([^"\\]*(?:\\.[^"\\]*)*)"|([A-Za-z_]\w*)|([^,"]*?))(?::[\w\[\]:]+)?\s*(?:,|$)')
+# MAL variables look like X_12 or C_3, everything else is a constant
+_VARIABLE = re.compile(r'[A-Z]+_\d+$')
+
+
+def _plan_args(text):
+    args = []
+    pos = 0
+    while pos < len(text):
+        m = _PLAN_ARG.match(text, pos)
+        if not m or m.end() == pos:
+            break
+        string, word, other = m.groups()
+        if string is not None:
+            args.append(Literal(_unquote(string)))
+        elif word is not None and _VARIABLE.match(word):
+            args.append(word)
+        else:
+            args.append(Literal(word if word is not None else other))
+        pos = m.end()
+    return args
+
+
+def instructions(plan):
+    """Return the assignments in the plan as Instructions.
+
+    Statements that are not assignments of a function call, such as
+    barriers and function headers, are skipped.
+    """
+    text = plan if isinstance(plan, str) else plan_text(plan)
+    result = []
+    for m in _ASSIGNMENT.finditer(text):
+        results, module, function, args = m.groups()
+        result.append(Instruction(
+            _RESULT.findall(results), module, function, _plan_args(args)))
+    return result
+
+
+Select = namedtuple('Select', ['column', 'kind'])
+Select.__doc__ = """A selection on a base column.
+
+column is a (schema, table, column) triple, kind is one of 'eq', 'ne',
+'range', 'like' and 'notnil'.
+"""
+
+Join = namedtuple('Join', ['left', 'right', 'kind'])
+Join.__doc__ = """A join between two base columns.
+
+left and right are (schema, table, column) triples or None when we
+couldn't tell where the join input came from.
+"""
+
+PlanSummary = namedtuple('PlanSummary', ['columns', 'tables', 'selects', 'joins'])
+PlanSummary.__doc__ = """What the memory estimate needs to know about a plan.
+
+columns is the set of (schema, table, column) triples bound by the
+plan, tables the set of (schema, table) pairs it touches. tables,
+selects and joins are None if only the columns were collected, see
+teiresias.Adviser.summary.
+"""
+
+_JOINS = {
+    'join': 'join',
+    'leftjoin': 'join',
+    'outerjoin': 'outer',
+    'semijoin': 'semi',
+    'thetajoin': 'theta',
+    'crossproduct': 'cross',
+}
+
+
+def summarize(plan):
+    """Collect the bound columns, selections and joins of a plan.
+
+    Selections and joins are attributed to base columns by following
+    the bind, projection and mat.pack instructions that lead up to them.
+    """
+    columns = set()
+    tables = set()
+    selects = []
+    joins = []
+    # variable -> (schema, table, column) it holds (a subset of)
+    column_of = {}
+
+    for ins in instructions(plan):
+        fn = ins.function
+        args = ins.args
+        if ins.module == 'sql' and fn in _KINDS:
+            strings = [a.value for a in args if isinstance(a, Literal)]
+            if len(strings) < 2 or (fn != 'tid' and len(strings) < 3):
+                continue
+            schema, table = strings[0], strings[1]
+            tables.add((schema, table))
+            if _KINDS[fn] == 'bind':
+                triple = (schema, table, strings[2])
+                columns.add(triple)
+                for r in ins.results:
+                    column_of[r] = triple
+            continue
+        if not args or not ins.results:
+            continue
+        source = column_of.get(args[0]) if isinstance(args[0], str) else None
+
+        if ins.module == 'algebra' and fn == 'projection' and len(args) == 2:
+            source = column_of.get(args[1]) if isinstance(args[1], str) else None
+            if source:
+                column_of[ins.results[0]] = source
+        elif ins.module == 'mat' and fn == 'pack':
+            if source:
+                column_of[ins.results[0]] = source
+        elif ins.module == 'algebra' and fn == 'thetaselect':
+            if source:
+                op = args[-1].value if isinstance(args[-1], Literal) else None
+                kind = 'eq' if op == '==' else 'ne' if op == '!=' else 'range'
+                selects.append(Select(source, kind))
+        elif ins.module == 'algebra' and fn == 'select':
+            if source:
+                # (b, [s,] low, high, li, hi, anti[, unknown])
+                literals = [a.value for a in args if isinstance(a, Literal)]
+                equal = len(literals) >= 5 and literals[0] == literals[1] and literals[4] == 'false'
+                selects.append(Select(source, 'eq' if equal else 'range'))
+        elif fn in ('likeselect', 'ilikeselect'):
+            if source:
+                selects.append(Select(source, 'like'))
+        elif ins.module == 'algebra' and fn == 'selectNotNil':
+            if source:
+                selects.append(Select(source, 'notnil'))
+        elif ins.module == 'algebra' and fn in _JOINS and len(args) >= 2:
+            right = column_of.get(args[1]) if isinstance(args[1], str) else None
+            joins.append(Join(source, right, _JOINS[fn]))
+
+    return PlanSummary(frozenset(columns), frozenset(tables), tuple(selects), tuple(joins))
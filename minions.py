@@ -1,5 +1,7 @@
 #
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import socket
 import time
 
@@ -34,6 +36,9 @@ STOPPING = State('STOPPING', 64, 80)
 STOPPED = State('STOPPED', 80)
 #
 READY = State('READY', RUNNING.code + 1)
+# Not an EC2 state, the target for a stopped instance whose type has to
+# change
+RESIZED = State('RESIZED', -2)
 
 _codemap = {
     0: PENDING,
@@ -45,6 +50,15 @@ _codemap = {
 }
 
 
+INSTANCE_TYPE_MEMORY_MiB = {
+    "t2.micro": 1024,
+    "t2.small": 2048,
+    "t2.medium": 4096,
+    "t2.large": 8192,
+    "t2.xlarge": 16384,
+}
+
+
 def state_from_code(n):
     """Map EC2 instance state code to its corresponding State object."""
     st = _codemap.get(n)
@@ -53,6 +67,120 @@ def state_from_code(n):
     return st
 
 
+def _recv_exactly(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return data
+
+
+def mapi_ready(ip, port=50000, timeout=1):
+    """Check that a MonetDB server is answering MAPI on ip:port.
+
+    A MonetDB server (or monetdbd in front of it) starts every connection
+    by sending a challenge block salt:servertype:protocol:... so we read
+    that and check the server type instead of only connecting.
+    """
+    try:
+        with socket.create_connection((ip, port), timeout=timeout) as s:
+            # two byte little endian header, length << 1 | last
+            header = _recv_exactly(s, 2)
+            length = int.from_bytes(header, 'little') >> 1
+            challenge = _recv_exactly(s, length)
+    except OSError:
+        return False
+    fields = challenge.split(b':')
+    return len(fields) > 2 and fields[1] in (b'merovingian', b'mserver')
+
+
+InstanceInfo = namedtuple('InstanceInfo', ['state', 'ip', 'instance_type'])
+
+
+class InstanceStateCache:
+    """State, private ip and type of the instances of all minions.
+
+    refresh() asks EC2 about all registered instances at once, with a
+    single describe_instances call (more if there are very many), instead
+    of one call per instance per attribute. Minions read from here.
+
+    RUNNING instances are then probed concurrently with probe(ip), which
+    defaults to mapi_ready. Those that answer get state READY.
+    """
+
+    # instance ids per describe_instances call
+    batch_size = 1000
+    # concurrent readiness probes
+    probe_workers = 32
+
+    def __init__(self, ec2, probe=mapi_ready):
+        self.ec2 = ec2
+        self.probe = probe
+        self._executor = None
+        self._ids = set()
+        # replaced as a whole on every refresh
+        self._info = {}
+        self.last_refresh = None
+        self.calls = 0
+
+    def register(self, id):
+        self._ids.add(id)
+
+    def get(self, id):
+        """Return the InstanceInfo of instance id or None if EC2 doesn't
+        know about it (anymore)."""
+        return self._info.get(id)
+
+    def refresh(self):
+        ids = sorted(self._ids)
+        if not ids:
+            return
+        client = self.ec2.meta.client
+        info = {}
+        try:
+            for i in range(0, len(ids), self.batch_size):
+                # a filter rather than InstanceIds because that fails
+                # the whole call if one of them is gone
+                kwargs = dict(Filters=[dict(Name='instance-id', Values=ids[i:i + self.batch_size])])
+                while True:
+                    self.calls += 1
+                    response = client.describe_instances(**kwargs)
+                    for reservation in response['Reservations']:
+                        for inst in reservation['Instances']:
+                            # the high byte of the code is internal to AWS
+                            state = state_from_code(inst['State']['Code'] & 0xFF)
+                            info[inst['InstanceId']] = InstanceInfo(
+                                state, inst.get('PrivateIpAddress'), inst.get('InstanceType'))
+                    token = response.get('NextToken')
+                    if not token:
+                        break
+                    kwargs['NextToken'] = token
+        except Exception as e:
+            # probably throttled, try again next time
+            print(f"Could not refresh instance states: {e}")
+            return
+        self._probe(info)
+        self._info = info
+        self.last_refresh = time.time()
+
+    def _probe(self, info):
+        running = [id for id, inf in info.items() if inf.state == RUNNING and inf.ip]
+        if not running:
+            return
+        if len(running) == 1:
+            results = [self.probe(info[running[0]].ip)]
+        else:
+            if not self._executor:
+                self._executor = ThreadPoolExecutor(
+                    self.probe_workers, thread_name_prefix='probe')
+            results = self._executor.map(self.probe, [info[id].ip for id in running])
+        for id, ready in zip(running, results):
+            if ready:
+                info[id] = info[id]._replace(state=READY)
+
+
 class Minion:
     """Information about current and desired state of a minion, and what
     we're doing about it.
@@ -63,49 +191,90 @@ class Minion:
         Rule([PENDING], RUNNING, "wait"),
         Rule([RUNNING], READY, "wait"),
         Rule([RUNNING, READY], STOPPING, "stop"),
-        Rule([STOPPING], STOPPED, "wait")
+        Rule([STOPPING], STOPPED, "wait"),
+        Rule([STOPPED], RESIZED, "modify"),
     ])
 
-    def __init__(self, ec2, name, id=None):
+    # failed actions before a resize is given up
+    max_failures = 3
+
+    def __init__(self, ec2, name, id=None, cache=None, clock=time.time):
         self.ec2 = ec2
         self.name = name
         self.id = id
+        self._clock = clock
+        if cache is None:
+            cache = InstanceStateCache(ec2)
+            if id:
+                cache.register(id)
+                cache.refresh()
+        self.cache = cache
 
         self.observed_state = None
         self.desired_state = None
+        # Set by resize() to change the instance type. The instance is
+        # stopped if necessary, modified, and then brought to
+        # desired_state.
+        self.desired_instance_type = None
+        # True from resize() until the instance has the new type. Without
+        # it a running minion keeps its type until it is stopped.
+        self._resize_wanted = False
+        # set when a resize was given up, for the Pool to notice
+        self.resize_failed = False
+        # actions that raised since the last one that didn't
+        self.failures = 0
         self.last_action = None
         self.last_action_state = None
         self.last_action_time = None
 
         self.refresh()
+        # what to go back to once a resized minion is stopped
+        self.base_instance_type = self.instance_type
 
     instance = property(
         lambda self: self.ec2.Instance(self.id) if self.id else None,
         doc="boto3 Instance object belonging to this minion")
 
-    ip = property(lambda self: self.instance.private_ip_address)
+    info = property(
+        lambda self: self.cache.get(self.id) if self.id else None,
+        doc="InstanceInfo from the last refresh of the cache")
+
+    ip = property(lambda self: self.info.ip if self.info else None)
+
+    instance_type = property(lambda self: self.info.instance_type if self.info else None)
+
+    @property
+    def resizing(self):
+        """True if the instance type is going to change: resize() was
+        called, or the minion is to be stopped and shrunk to its base
+        type"""
+        wanted = self.desired_instance_type
+        if not wanted or self.info is None or wanted == self.info.instance_type:
+            return False
+        return self._resize_wanted or self.desired_state == STOPPED
+
+    @property
+    def memory(self):
+        """Bytes of memory of the instance type this minion has or is
+        being resized to, None if unknown"""
+        itype = self.desired_instance_type if self.resizing else self.instance_type
+        mib = INSTANCE_TYPE_MEMORY_MiB.get(itype)
+        return mib * 1024 * 1024 if mib else None
+
+    def resize(self, instance_type):
+        """Change to instance_type, stopping the instance if necessary"""
+        self.desired_instance_type = instance_type
+        self._resize_wanted = True
 
     def refresh(self):
-        if not self.id:
+        """Update observed_state from the InstanceStateCache, which must
+        have been refreshed before. The cache has already probed RUNNING
+        instances so they show up as READY when they answer."""
+        info = self.info
+        if not info:
             self.observed_state = NONEXISTENT
             return
-        state = state_from_code(self.instance.state['Code'])
-        if state == RUNNING:
-            if self.pings():
-                state = READY
-        self.observed_state = state
-
-    def pings(self):
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(1)
-            s.connect((self.ip, 50000))
-            s.close()
-            return True
-        except ConnectionRefusedError:
-            return False
-        except socket.timeout:
-            return False
+        self.observed_state = info.state
 
     def make(self, desired_state):
         assert desired_state in [
@@ -117,15 +286,24 @@ class Minion:
             STOPPING,
             STOPPED,
             READY]
-        self.refresh()
+        # No refresh here, make is called with the pool lock held.
+        # The observed state is at most one poll old.
         if self.observed_state != desired_state and not self.engine.plan(self.observed_state, desired_state):
             return False
         self.desired_state = desired_state
+        if desired_state == STOPPED and self.base_instance_type:
+            # Only DOWN members are told to stop, FINISHING ones keep
+            # running their queries. Don't keep large instances around,
+            # shrink while stopped.
+            self.desired_instance_type = self.base_instance_type
+            self._resize_wanted = False
         return True
 
     def poll(self):
-        self.refresh()
+        """Take the next step towards the desired state.
 
+        Acts on the observed state of the last refresh().
+        """
         desired = self.desired_state
         observed = self.observed_state
 
@@ -133,7 +311,13 @@ class Minion:
             # Starts out as None.
             return
 
-        if observed == desired:
+        if self._resize_wanted and not self.resizing and observed == READY:
+            # done
+            self._resize_wanted = False
+        if self.resizing:
+            # first get there, then to desired
+            desired = RESIZED
+        elif observed == desired:
             # We're already there
             return
 
@@ -146,43 +330,66 @@ class Minion:
 
         if action == self.last_action and observed == self.last_action_state:
             # don't retry too often
-            if time.time() - self.last_action_time < 60:
+            if self._clock() - self.last_action_time < 60:
                 return
 
-        # Ok, do it.
-        if action == 'start':
-            print(f"* START {self.name}")
-            self.instance.start()
-        elif action == 'stop':
-            print(f"* STOP {self.name}")
-            self.instance.stop()
-        elif action == 'wait':
-            pass
-        else:
-            assert(False)
-
         self.last_action = action
         self.last_action_state = observed
-        self.last_action_time = time.time()
+        self.last_action_time = self._clock()
 
+        # Ok, do it.
+        try:
+            if action == 'start':
+                print(f"* START {self.name}")
+                self.instance.start()
+            elif action == 'stop':
+                print(f"* STOP {self.name}")
+                self.instance.stop()
+            elif action == 'modify':
+                print(f"* MODIFY {self.name} to {self.desired_instance_type}")
+                self.ec2.meta.client.modify_instance_attribute(
+                    InstanceId=self.id, InstanceType=dict(Value=self.desired_instance_type))
+            elif action == 'wait':
+                pass
+            else:
+                assert(False)
+        except Exception as e:
+            # e.g. InsufficientInstanceCapacity, try again later
+            self.failures += 1
+            print(f"Could not {action} {self.name}: {e}")
+            if self._resize_wanted and self.failures >= self.max_failures:
+                print(f"Giving up resizing {self.name} to {self.desired_instance_type}")
+                self.desired_instance_type = self.instance_type
+                self._resize_wanted = False
+                self.resize_failed = True
+            return
+        self.failures = 0
 
-def track_down_minions(ec2, tags):
-    """Look for EC2 instances with certain tags and create Minion instances for them"""
+
+def track_down_minions(ec2, tags, cache=None, clock=time.time):
+    """Look for EC2 instances with certain tags and create Minion instances for them
+
+    The minions share cache, which is refreshed here. After that it's up to
+    the caller to refresh it regularly.
+    """
 
     filters = [
         dict(Name=f'tag:{k}', Values=[v])
         for (k, v) in tags.items()
     ]
-    instances = ec2.instances.filter(Filters=filters)
-    minions = []
+    if cache is None:
+        cache = InstanceStateCache(ec2)
+    found = []
     for instance in ec2.instances.filter(Filters=filters):
-        if instance.state['Code'] == TERMINATED.code:
+        if instance.state['Code'] & 0xFF == TERMINATED.code:
             continue
         id = instance.id
         tags = dict((d['Key'], d['Value']) for d in instance.tags)
         name = tags.get('Name')
         if name == None:
             raise Exception(f"Instance {id} has no Name tag")
-        m = Minion(ec2, name, id)
-        minions.append(m)
+        cache.register(id)
+        found.append((name, id))
+    cache.refresh()
+    minions = [Minion(ec2, name, id, cache, clock) for name, id in found]
     return sorted(minions, key=lambda m: m.name)
@@ -1,6 +1,7 @@
 #
 
 from collections import defaultdict
+import math
 import random
 import threading
 import time
@@ -9,17 +10,36 @@ from minions import Minion, NONEXISTENT, PENDING, RUNNING, SHUTTING_DOWN, TERMIN
 
 
 class Pool:
+    # When set, a claim with a footprint adds the fraction of the member's
+    # memory it reserves to the load instead of 1, but at least min_weight
+    weigh_load = False
+    min_weight = 0.1
 
-    def __init__(self, name, members):
+    def __init__(self, name, members, strategy=None, clock=time.time):
         self._lock = threading.Lock()
         self.name = name
+        self._clock = clock
+        self.strategy = strategy or RandomClaims()
         self._by_name = {}
         self._state = {}
         self._generation = {}
         self._claims = {}
+        # bytes of memory the running claims on each member expect to use
+        self._reserved = {}
+        # load the running claims on each member added to loadaverage
+        self._weight = {}
+        # state and (state, claimed) -> _MemberSet, kept up to date by
+        # _set_member_state and _set_claims
+        self._index = defaultdict(_MemberSet)
         self._desired_up = 0
         self.shrink_allowed = True
-        self.loadaverage = LoadAverage()
+        self.loadaverage = LoadAverage(clock=clock)
+        self._listeners = []
+        self._activity_listeners = []
+        self._release_listeners = []
+        # members being resized for a particular query, the down rule
+        # leaves them alone until they are UP
+        self._pinned = set()
 
         for m in members:
             name = m.name
@@ -37,13 +57,48 @@ class Pool:
             self._state[name] = state
             self._generation[name] = 0
             self._claims[name] = 0
+            self._reserved[name] = 0
+            self._weight[name] = 0
+            self._index_member(name)
             # sends command to the minion
             self._set_member_state(name, state)
 
         # Assume this is just how we want it.
         # User will probably call set_des
-        self._desired_up = sum(1 for st in self._state.values()
-                               if st in ['UP', 'STARTING'])
+        self._desired_up = len(self._index['UP']) + len(self._index['STARTING'])
+
+    def add_listener(self, listener):
+        """Call listener(pool, name, state) whenever a member changes state.
+
+        The listener is called with the pool lock held so it must not call
+        back into the pool.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def add_activity_listener(self, listener):
+        """Call listener(pool) after every claim and release and whenever
+        the desired size changes.
+
+        Like the listeners of add_listener it is called with the pool lock
+        held, and it is called often, so it should do little more than
+        set an Event.
+        """
+        with self._lock:
+            self._activity_listeners.append(listener)
+
+    def add_release_listener(self, listener):
+        """Call listener(pool) after a claim has been released.
+
+        Unlike the other listeners it is called without the pool lock, so
+        it can claim members.
+        """
+        with self._lock:
+            self._release_listeners.append(listener)
+
+    def _activity(self):
+        for listener in self._activity_listeners:
+            listener(self)
 
     def members(self):
         with self._lock:
@@ -53,17 +108,33 @@ class Pool:
             ]
 
     def poll(self):
+        # Ask EC2 and the minions how they are doing. This is slow so it
+        # happens without the lock, claims and releases carry on meanwhile.
+        # The set of members never changes so _by_name needs no lock.
+        members = list(self._by_name.values())
+        for member in members:
+            member.refresh()
+
         # Change our state info based on the observed minion state
         with self._lock:
             for name, member in self._by_name.items():
-                member.refresh()
                 state = self._state[name]
                 observed = member.observed_state
                 # the following is so ad-hoc that it's almost certainly
                 # wrong :(
-                if state == 'STARTING' and observed == READY:
+                if name in self._pinned and getattr(member, 'resize_failed', False):
+                    # it will come up as it was, or not at all
+                    member.resize_failed = False
+                    self._pinned.discard(name)
+                if state == 'STARTING' and observed == READY and not getattr(member, 'resizing', False):
+                    self._pinned.discard(name)
                     self._generation[name] += 1
-                    self._claims[name] = 0
+                    self._set_claims(name, 0)
+                    self._reserved[name] = 0
+                    # the claims of the previous generation won't be
+                    # released
+                    self.loadaverage.remove_load(self._weight[name])
+                    self._weight[name] = 0
                     self._set_member_state(name, 'UP')
                 if state == 'UP' and observed != READY:
                     self._set_member_state(name, 'STARTING')
@@ -82,12 +153,14 @@ class Pool:
                     minion.make(STOPPED)
                 else:
                     assert('banana')
-            for name, minion in self._by_name.items():
-                minion.poll()
+
+        # Starting and stopping instances is slow too
+        for member in members:
+            member.poll()
 
     def _actual(self):
         with self._lock:
-            return sum(1 for s in self._state.values() if s in ['UP', 'FINISHING'])
+            return len(self._index['UP']) + len(self._index['FINISHING'])
 
     actual = property(_actual)
 
@@ -101,7 +174,9 @@ class Pool:
                 n = 0
             if n > len(self._by_name):
                 n = len(self._by_name)
-            self._desired_up = n
+            if n != self._desired_up:
+                self._desired_up = n
+                self._activity()
 
     desired = property(_get_desired, _set_desired)
 
@@ -122,31 +197,63 @@ class Pool:
         assert(name in self._state)
         assert(state in ['STARTING', 'UP', 'FINISHING', 'DOWN'])
         oldstate = self._state[name]
-        self._state[name] = state
         if oldstate != state:
+            self._unindex_member(name)
+            self._state[name] = state
+            self._index_member(name)
             claims = self._claims[name]
             print(f"~ ({name} now {state}/{claims})")
+            for listener in self._listeners:
+                listener(self, name, state)
             result = True
         else:
             result = False
         member = self._by_name[name]
-        if state in ['STARTING', 'UP']:
+        if state in ['STARTING', 'UP', 'FINISHING']:
+            # FINISHING members still have queries to run
             member.make(READY)
         else:
+            self._pinned.discard(name)
             member.make(STOPPED)
+        return result
+
+    def _set_claims(self, name, n):
+        if (self._claims[name] > 0) != (n > 0):
+            self._unindex_member(name)
+            self._claims[name] = n
+            self._index_member(name)
+        else:
+            self._claims[name] = n
+
+    def _index_member(self, name):
+        state = self._state[name]
+        claimed = self._claims[name] > 0
+        # long live dynamic typing
+        self._index[state].add(name)
+        self._index[(state, claimed)].add(name)
+
+    def _unindex_member(self, name):
+        state = self._state[name]
+        claimed = self._claims[name] > 0
+        self._index[state].discard(name)
+        self._index[(state, claimed)].discard(name)
 
     def classify(self):
-        result = defaultdict(list)
-        for name, state in self._state.items():
-            claimed = self._claims[name] > 0
-            key = (state, claimed)
-            # long live dynamic typing
-            result[state].append(name)
-            result[key].append(name)
-        return result
+        """Return lists of member names keyed by state and (state, claimed)"""
+        with self._lock:
+            result = defaultdict(list)
+            for key, names in self._index.items():
+                if names:
+                    result[key] = list(names)
+            return result
+
+    def count(self, key):
+        """Number of members in state key, or in (state, claimed) key"""
+        with self._lock:
+            return len(self._index[key])
 
     def _up_rule_once(self):
-        cfy = self.classify()
+        cfy = self._index
         starting = cfy['STARTING']
         up = cfy['UP']
 
@@ -172,7 +279,7 @@ class Pool:
         return True
 
     def _down_rule_once(self):
-        cfy = self.classify()
+        cfy = self._index
         starting = cfy['STARTING']
         up = cfy['UP']
 
@@ -185,7 +292,8 @@ class Pool:
             # this idle minion can be stopped instantly
             return self._set_member_state(up0[0], 'DOWN')
 
-        starting = cfy['STARTING']
+        if self._pinned:
+            starting = [name for name in starting if name not in self._pinned]
         if starting:
             # better to kill a starting node because we don't have to
             # wait for the queries do drain
@@ -194,8 +302,11 @@ class Pool:
         upn = cfy[('UP', True)]
         # there were too many nodes either starting or up.
         # they weren't any STARTING nodes and there weren't
-        # any UP(n==0) nodes so there must be at least one UP(n>0).
-        assert(upn)
+        # any UP(n==0) nodes so there must be at least one UP(n>0),
+        # unless the STARTING ones are being resized.
+        if not upn:
+            assert(self._pinned)
+            return False
         return self._set_member_state(upn[0], 'FINISHING')
 
     def _down_rule(self):
@@ -206,42 +317,186 @@ class Pool:
             pass
         return True
 
-    def claim(self):
+    def reserved(self):
+        """Bytes reserved by running claims, per member"""
+        with self._lock:
+            return dict(self._reserved)
+
+    def claim(self, idle_only=False, footprint=None, background=False):
+        """Claim an UP member, or return None if there is none.
+
+        With idle_only, only members without claims will do. With a
+        footprint, the bytes of memory the query is expected to need,
+        only members with that much room left are considered, see _fit,
+        and the footprint is reserved until the claim is released. A background claim, for housekeeping,
+        doesn't count toward the load so it doesn't keep the pool from
+        shrinking.
+        """
         with self._lock:
-            cfy = self.classify()
-            ups = cfy['UP']
+            ups = self._index['UP']
+            idle = self._index[('UP', False)]
+            if idle_only:
+                ups = idle
             if not ups:
                 return None
-            victim = random.choice(ups)
-            self._claims[victim] += 1
-            self.loadaverage.add_load(1)
-            return Claim(self, victim, self._by_name[victim].ip, self._generation[victim])
+            if footprint is None:
+                victim = self.strategy.pick(ups, idle, self._claims)
+            else:
+                victim = self._fit(ups, idle, footprint)
+                if victim is None:
+                    return None
+                self._reserved[victim] += footprint
+            weight = 0 if background else self._weigh(victim, footprint)
+            self._weight[victim] += weight
+            self._set_claims(victim, self._claims[victim] + 1)
+            if weight:
+                self.loadaverage.add_load(weight)
+            self._activity()
+            return Claim(self, victim, self._by_name[victim].ip, self._generation[victim], self._clock(), footprint, weight)
+
+    def _weigh(self, name, footprint):
+        return self._weigh_memory(getattr(self._by_name[name], 'memory', None), footprint)
+
+    def _weigh_memory(self, mem, footprint):
+        if not self.weigh_load or footprint is None or not mem:
+            return 1
+        return max(self.min_weight, min(1.0, footprint / mem))
+
+    def carry(self, claim):
+        """Count claim, on a member of another pool, as load of this pool
+        until it is released. A query that spilled over to a larger pool
+        was meant for this one, which should still grow for it."""
+        weight = self._weigh_memory(self.memory(), claim.footprint)
+        with self._lock:
+            self.loadaverage.add_load(weight)
+            self._activity()
+        claim._carriers.append((self, weight))
 
-    def _release(self, name, generation):
+    def _uncarry(self, weight):
+        with self._lock:
+            self.loadaverage.remove_load(weight)
+            self._activity()
+
+    def _fit(self, candidates, idle, footprint):
+        # The strategy picks from the members with room for footprint.
+        # Members that don't know their memory have room for anything.
+        # If none has room right now but one will once its queries are
+        # done, or once it has been resized, wait for that. If it can't
+        # fit anywhere, take the member with the most room left, that's
+        # what we did before we knew about memory.
+        fitting = [name for name in candidates if self._room(name) >= footprint]
+        if fitting:
+            fitting_idle = [name for name in idle if self._room(name) >= footprint]
+            return self.strategy.pick(fitting, fitting_idle, self._claims)
+        for name in list(self._index['UP']) + list(self._pinned):
+            mem = getattr(self._by_name[name], 'memory', None)
+            if not mem or mem >= footprint:
+                return None
+        return max(candidates, key=lambda name: (self._room(name), -self._claims[name]))
+
+    def _room(self, name):
+        mem = getattr(self._by_name[name], 'memory', None)
+        return mem - self._reserved[name] if mem else math.inf
+
+    def _release(self, name, generation, started, footprint, weight):
         with self._lock:
             if self._generation[name] != generation:
                 return
+            self.strategy.observe(name, self._clock() - started)
+            if footprint is not None:
+                self._reserved[name] -= footprint
             claims = self._claims[name]
             assert claims > 0
-            self._claims[name] -= 1
-            self.loadaverage.remove_load(1)
+            self._set_claims(name, claims - 1)
+            self._weight[name] -= weight
+            if weight:
+                self.loadaverage.remove_load(weight)
             if claims == 1:
                 # now 0
                 if self._state[name] == 'FINISHING':
                     self._set_member_state(name, 'DOWN')
+            self._activity()
+        for listener in self._release_listeners:
+            listener(self)
+
+    def memory(self):
+        """The most memory any member has or will have after resizing,
+        None if the members don't say."""
+        with self._lock:
+            sizes = [getattr(m, 'memory', None) for m in self._by_name.values()]
+            sizes = [s for s in sizes if s]
+            return max(sizes) if sizes else None
+
+    def resize(self, instance_type):
+        """Get a member going with the given instance type.
+
+        Takes a DOWN member if there is one, it only needs its type
+        changed before it starts, otherwise an idle UP member, which has
+        to stop first. The member becomes STARTING and stays so until it
+        is READY with the new type. Returns its name, or None if all
+        members are busy.
+        """
+        with self._lock:
+            down = self._index['DOWN']
+            idle = self._index[('UP', False)]
+            if down:
+                name = down[0]
+                self._desired_up += 1
+            elif idle:
+                name = idle[0]
+            else:
+                return None
+            member = self._by_name[name]
+            member.resize(instance_type)
+            self._pinned.add(name)
+            self._set_member_state(name, 'STARTING')
+            self._activity()
+            return name
+
+    def transitional(self):
+        """True if some member is on its way up or down."""
+        with self._lock:
+            if self._index['STARTING'] or self._index['FINISHING']:
+                return True
+            for minion in self._by_name.values():
+                observed = minion.observed_state
+                if observed.destination_code is not None:
+                    return True
+                if getattr(minion, 'resizing', False):
+                    return True
+                desired = minion.desired_state
+                if desired and desired != observed:
+                    return True
+            return False
 
 
 class Claim:
-    def __init__(self, pool, name, ip, generation):
+    def __init__(self, pool, name, ip, generation, started, footprint=None, weight=1):
         self.name = name
         self.ip = ip
         self._pool = pool
         self._generation = generation
+        self._started = started
+        self._footprint = footprint
+        self._weight = weight
         self._released = False
+        # (pool, weight) of the pools that count this claim too, see
+        # Pool.carry
+        self._carriers = []
+
+    generation = property(lambda self: self._generation)
+
+    footprint = property(lambda self: self._footprint, doc="bytes reserved on the member, or None")
+
+    weight = property(lambda self: self._weight, doc="what the claim adds to the load of the pool")
+
+    pool_name = property(lambda self: self._pool.name)
 
     def release(self):
         if not self._released:
-            self._pool._release(self.name, self._generation)
+            self._pool._release(self.name, self._generation, self._started, self._footprint, self._weight)
+            for pool, weight in self._carriers:
+                pool._uncarry(weight)
             self._released = True
 
     def __enter__(self):
@@ -253,61 +508,198 @@ class Claim:
         self.release()
 
 
+class _MemberSet:
+    """A set of member names that can also be indexed, so picking a
+    random one is O(1)."""
+
+    def __init__(self):
+        self._names = []
+        self._pos = {}
+
+    def add(self, name):
+        if name not in self._pos:
+            self._pos[name] = len(self._names)
+            self._names.append(name)
+
+    def discard(self, name):
+        i = self._pos.pop(name, None)
+        if i is None:
+            return
+        last = self._names.pop()
+        if last != name:
+            # move the last one into the hole
+            self._names[i] = last
+            self._pos[last] = i
+
+    def __len__(self):
+        return len(self._names)
+
+    def __getitem__(self, i):
+        return self._names[i]
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __contains__(self, name):
+        return name in self._pos
+
+
+class RandomClaims:
+    """Claim strategy: any UP member will do"""
+
+    def pick(self, candidates, idle, claims):
+        """Choose one of the candidates (the UP members).
+
+        idle holds the candidates that have no claims, claims maps each
+        member name to its number of claims. Both can be indexed but
+        are not lists.
+        """
+        return random.choice(candidates)
+
+    def observe(self, name, duration):
+        pass
+
+
+class LeastClaims(RandomClaims):
+    """Claim strategy: the member with the fewest claims"""
+
+    def pick(self, candidates, idle, claims):
+        if idle:
+            return random.choice(idle)
+        return min(candidates, key=lambda name: (claims[name], random.random()))
+
+
+class PowerOfTwoClaims(RandomClaims):
+    """Claim strategy: the least claimed of two random members"""
+
+    def pick(self, candidates, idle, claims):
+        n = len(candidates)
+        if n < 2:
+            return candidates[0]
+        i = random.randrange(n)
+        j = random.randrange(n - 1)
+        if j >= i:
+            j += 1
+        a, b = candidates[i], candidates[j]
+        return a if claims[a] <= claims[b] else b
+
+
+class LatencyWeightedClaims(RandomClaims):
+    """Claim strategy: prefer members that have been finishing quickly.
+
+    Keeps a moving average of how long claims on each member last. The
+    number of claims on a member, plus one for us, is scaled by how much
+    slower or faster than average that member is. The scale is kept
+    between 0.5 and 2 because query durations vary so much that the
+    averages are noisy.
+    """
+
+    def __init__(self, weight=0.05):
+        self.weight = weight
+        self._latency = {}
+
+    def pick(self, candidates, idle, claims):
+        latency = self._latency
+        mean = sum(latency.values()) / len(latency) if latency else 0
+
+        def slowness(name):
+            if not mean:
+                return 1.0
+            return min(2.0, max(0.5, latency.get(name, mean) / mean))
+
+        return min(
+            candidates,
+            key=lambda name: ((claims[name] + 1) * slowness(name), random.random()))
+
+    def observe(self, name, duration):
+        old = self._latency.get(name)
+        if old is None:
+            self._latency[name] = duration
+        else:
+            self._latency[name] = old + self.weight * (duration - old)
+
+
+STRATEGIES = dict(
+    random=RandomClaims,
+    least=LeastClaims,
+    p2c=PowerOfTwoClaims,
+    latency=LatencyWeightedClaims,
+)
+
+
 class LoadAverage:
-    def __init__(self, half_life=60):
+    """The load right now plus an echo of the load that was removed
+    recently, fading with half_life seconds.
+
+    The echo is tracked for each of half_lives as well, like the 1, 5 and
+    15 minute load averages of Unix, see averages. Loads can be any
+    non-negative number, see Pool.weigh_load. Every update costs the same
+    however long the LoadAverage has been running.
+    """
+
+    def __init__(self, half_life=60, clock=time.time, half_lives=(60, 300, 900)):
         self.half_life = half_life
-        self._alpha = 0.5 ** (1.0 / half_life)
+        self.half_lives = (half_life,) + tuple(h for h in half_lives if h != half_life)
+        self._alphas = [0.5 ** (1.0 / h) for h in self.half_lives]
         self._load = 0
-        self._echo = 0
+        # one per half life, the first one is for half_life
+        self._echoes = [0] * len(self.half_lives)
+        self._clock = clock
 
-        now = time.time()
+        now = clock()
         self._start_time = now
         self._last_change = now
         self._last_echo_update = now
 
     @property
     def load(self):
-        now = time.time()
+        now = self._clock()
         elapsed = now - self._last_echo_update
-        echo = self._echo * self._alpha ** elapsed
+        echo = self._echoes[0] * self._alphas[0] ** elapsed
         return self._load + echo
 
+    def averages(self):
+        """Map each of half_lives to the load with that half life"""
+        now = self._clock()
+        elapsed = now - self._last_echo_update
+        return dict(
+            (h, self._load + echo * alpha ** elapsed)
+            for h, echo, alpha in zip(self.half_lives, self._echoes, self._alphas))
+
     @property
     def time_since_change(self):
-        now = time.time()
+        now = self._clock()
         return now - self._last_change
 
     @property
     def time_running(self):
-        now = time.time()
+        now = self._clock()
         return now - self._start_time
 
     def _update_echo(self, now):
         elapsed = now - self._last_echo_update
-        self._echo *= self._alpha ** elapsed
+        self._echoes = [echo * alpha ** elapsed for echo, alpha in zip(self._echoes, self._alphas)]
         self._last_echo_update = now
 
     def add_load(self, amount):
         assert amount >= 0
-        now = time.time()
+        now = self._clock()
         self._last_change = now
 
         self._update_echo(now)
         self._load += amount
-        self._echo -= amount
-        if self._echo < 0:
-            self._echo = 0
+        self._echoes = [max(0, echo - amount) for echo in self._echoes]
 
     def remove_load(self, amount):
         assert amount >= 0
-        now = time.time()
+        now = self._clock()
         self._last_change = now
         if amount > self._load:
             amount = self._load
 
         self._update_echo(now)
         self._load -= amount
-        self._echo += amount
+        self._echoes = [echo + amount for echo in self._echoes]
 
     def adjust_load(self, amount):
         if amount > 0:
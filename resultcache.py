@@ -0,0 +1,88 @@
+#
+
+# Results of read-only queries, so a dashboard asking the same thing every
+# few seconds doesn't need a minion for it.
+#
+# Entries expire after ttl seconds and the least recently used ones go
+# when the results together take more than max_bytes. The Backend drops
+# everything when the storage stats change, and on request.
+
+from collections import OrderedDict
+import threading
+import time
+
+
+def result_size(value):
+    """Rough number of bytes value takes, good enough to bound the cache"""
+    if isinstance(value, (list, tuple)):
+        return 8 * len(value) + sum(result_size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(result_size(k) + result_size(v) for k, v in value.items())
+    if isinstance(value, (str, bytes)):
+        return 40 + len(value)
+    return 24
+
+
+class ResultCache:
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=60, clock=time.time):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # key -> (expires, size, value)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] <= self._clock():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, value, size=None):
+        """Remember value, unless it takes more than a tenth of max_bytes"""
+        if size is None:
+            size = result_size(value)
+        if size > self.max_bytes / 10:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (self._clock() + self.ttl, size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+            return True
+
+    def clear(self):
+        with self._lock:
+            n = len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+            return n
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                size=len(self._entries),
+                bytes=self._bytes,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+
+# Replay query arrivals against the real Pool, LoadAverage, Minion and
+# autoscale code, with FakeEC2 standing in for AWS, on a virtual clock.
+#
+# Usage: simulator.py TRACE [--policy NAME] [options]
+#
+# TRACE is either
+#
+#   - a file with one JSON object per line, {"arrival": 12.5, "duration": 3.2}
+#     with times in seconds, and optionally "pool": "LARGE", "memory" (the
+#     bytes the query needs), "client" and "priority". Queries with a
+#     memory but no pool go to the pool that Adviser.advise would pick, or
+#   - a status timeline such as data.json. Queries are then generated
+#     so that on average as many are running as the recorded load says,
+#     with exponentially distributed durations of mean --duration seconds.
+#
+# Queries go through the pools' AdmissionQueues and the spillover policy
+# like in Backend.claim_for_advice, and claim members with room for their
+# memory. The control loop does what Backend._polling_loop does: refresh
+# the instance states, poll the pools, let autoscale.decide set their
+# size and dispatch the queues, quickly while minions are starting or
+# stopping and with growing intervals when nothing happens. Every minion
+# runs its queries processor-sharing style on --cores cores. Without
+# --policy all policies in autoscale.POLICIES are compared.
+
+import argparse
+import contextlib
+import heapq
+import io
+import json
+import math
+import random
+
+import admission
+import autoscale
+from fakes import FakeEC2
+import minions
+import pool
+
+# as in Backend
+POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 8
+WAKEUP_DELAY = 0.05
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Query:
+    def __init__(self, arrival, duration, pool_name, memory=None, client=None, priority=0):
+        self.arrival = arrival
+        self.remaining = duration
+        self.pool_name = pool_name
+        self.memory = memory
+        self.client = client
+        self.priority = priority
+        self.claim = None
+        self.waiter = None
+        self.started = None
+        self.finished = None
+        # rejected by or expired in the admission queue
+        self.rejected = False
+
+
+def load_queries(path, pool_names, duration, seed):
+    with open(path) as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = None
+    if isinstance(data, list):
+        return queries_from_timeline(data, pool_names, duration, seed)
+
+    queries = []
+    for line in text.splitlines():
+        if line.strip():
+            rec = json.loads(line)
+            queries.append(Query(
+                rec['arrival'], rec['duration'], rec.get('pool'), rec.get('memory'),
+                rec.get('client'), rec.get('priority', 0)))
+    if queries:
+        start = min(q.arrival for q in queries)
+        for q in queries:
+            q.arrival -= start
+    return queries
+
+
+def queries_from_timeline(timeline, pool_names, duration, seed):
+    # Little's law: on average load queries are running, so they arrive
+    # at a rate of load / duration
+    rng = random.Random(seed)
+    start = timeline[0]['timestamp'] / 1000.0
+    queries = []
+    for entry, following in zip(timeline, timeline[1:]):
+        t0 = entry['timestamp'] / 1000.0 - start
+        t1 = following['timestamp'] / 1000.0 - start
+        for name in pool_names:
+            load = entry['stats'].get(name, {}).get('load', 0)
+            if load <= 0:
+                continue
+            rate = load / duration
+            t = t0 + rng.expovariate(rate)
+            while t < t1:
+                queries.append(Query(t, rng.expovariate(1 / duration), name))
+                t += rng.expovariate(rate)
+    queries.sort(key=lambda q: q.arrival)
+    return queries
+
+
+def pick_pool(needed, specs):
+    # as teiresias.pick_machine: the smallest pool with enough memory,
+    # or the largest one
+    for name, mem in sorted(specs.items(), key=lambda item: (item[1], item[0])):
+        if needed < mem:
+            return name
+    return name
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class Simulation:
+
+    def __init__(self, queries, pool_names, policy_class, members, cores, boot, stop,
+                 instance_types=None, spillover='never', admission_options={}, weigh_load=False):
+        self.clock = VirtualClock()
+        self.queries = queries
+        self.cores = cores
+        self.spillover = spillover
+        admission_options = dict(admission_options)
+        self.deadline = admission_options.pop('deadline', None)
+        self.ec2 = FakeEC2(clock=self.clock, start_delay=boot, stop_delay=stop)
+        for name, itype in zip(pool_names, instance_types or ['t2.small'] * len(pool_names)):
+            for i in range(members):
+                self.ec2.add_instance(f"{name.lower()}{i:02d}", instance_type=itype, tags=dict(pool=name))
+        self.states = minions.InstanceStateCache(self.ec2, probe=lambda ip: True)
+        self.pools = {}
+        self.policies = {}
+        self.queues = {}
+        # pool name -> queries in its admission queue
+        self.waiting = {}
+        for name in pool_names:
+            ms = minions.track_down_minions(self.ec2, dict(pool=name), self.states, self.clock)
+            p = pool.Pool(name, ms, clock=self.clock)
+            p.weigh_load = weigh_load
+            p.add_activity_listener(lambda p: self._wake())
+            # as in Backend, a release lets the next one in
+            p.add_release_listener(lambda p: self._dispatch(p.name))
+            self.pools[name] = p
+            self.policies[name] = policy_class()
+            self.queues[name] = admission.AdmissionQueue(name, p.claim, clock=self.clock, **admission_options)
+            self.waiting[name] = []
+        self.specs = dict((name, p.memory()) for name, p in self.pools.items())
+        for q in queries:
+            if q.pool_name is None:
+                q.pool_name = pick_pool(q.memory, self.specs) if q.memory is not None else pool_names[0]
+        # member name -> running queries
+        self.running = {}
+
+        self._events = []
+        self._seq = 0
+        self._next_tick = None
+        self._interval = POLL_INTERVAL
+        self._last_refresh = -math.inf
+
+        self.queue_area = 0.0
+        self.max_queue = 0
+        self.vm_seconds = 0.0
+        self.spilled = 0
+        self.finished = 0
+
+    def _push(self, t, kind, item=None):
+        self._seq += 1
+        heapq.heappush(self._events, (t, self._seq, kind, item))
+
+    def _schedule_tick(self, t):
+        if self._next_tick is None or t < self._next_tick:
+            self._next_tick = t
+            self._push(t, 'tick')
+
+    def _wake(self):
+        # called by the pools after claims, releases and resizes
+        self._schedule_tick(self.clock.now + WAKEUP_DELAY)
+
+    def _rate(self, name):
+        return min(1.0, self.cores / len(self.running[name]))
+
+    def _next_completion(self):
+        best = math.inf
+        for name, running in self.running.items():
+            if running:
+                rate = self._rate(name)
+                best = min(best, min(q.remaining for q in running) / rate)
+        return self.clock.now + best
+
+    def _advance(self, t):
+        dt = t - self.clock.now
+        if dt <= 0:
+            return
+        for name, running in self.running.items():
+            if running:
+                rate = self._rate(name)
+                for q in running:
+                    q.remaining -= rate * dt
+        queued = sum(len(w) for w in self.waiting.values())
+        self.queue_area += queued * dt
+        billed = sum(
+            1 for inst in self.ec2.instances.filter()
+            if inst.state['Code'] in (minions.PENDING.code, minions.RUNNING.code))
+        self.vm_seconds += billed * dt
+        self.clock.now = t
+
+    def _start(self, q, claim):
+        q.claim = claim
+        q.started = self.clock.now
+        self.running.setdefault(claim.name, []).append(q)
+
+    def _reject(self, q):
+        q.rejected = True
+        q.finished = self.clock.now
+        self.finished += 1
+
+    def _dispatch(self, name):
+        # hand out claims and start the queries that got one
+        self.queues[name].dispatch()
+        self._collect(name)
+
+    def _collect(self, name):
+        still = []
+        for q in self.waiting[name]:
+            try:
+                claim = q.waiter.wait(0)
+            except admission.Rejected:
+                self._reject(q)
+                continue
+            if claim:
+                self._start(q, claim)
+            else:
+                still.append(q)
+        self.waiting[name] = still
+
+    def _larger_pools(self, name):
+        mem = self.specs[name]
+        larger = [n for n in self.pools if self.specs[n] > mem]
+        return [self.pools[n] for n in sorted(larger, key=lambda n: self.specs[n])]
+
+    def _spill(self, q, idle_only):
+        # what Backend._spill does, keeping the place in the queue if
+        # nothing is found
+        for p in self._larger_pools(q.pool_name):
+            claim = p.claim(idle_only, q.memory)
+            if claim:
+                q.waiter.cancel()
+                self.waiting[q.pool_name].remove(q)
+                self.spilled += 1
+                self.pools[q.pool_name].carry(claim)
+                self._start(q, claim)
+                return
+
+    def _arrive(self, q):
+        name = q.pool_name
+        try:
+            q.waiter = self.queues[name].enter(q.client, q.priority, self.deadline, q.memory)
+        except admission.Rejected:
+            self._reject(q)
+            return
+        self.waiting[name].append(q)
+        self._collect(name)
+        if q.claim:
+            return
+        self.max_queue = max(self.max_queue, sum(len(w) for w in self.waiting.values()))
+        if self.deadline is not None:
+            self._push(self.clock.now + self.deadline, 'deadline', q)
+        if self.spillover == 'idle':
+            self._spill(q, True)
+        elif self.spillover != 'never':
+            self._push(self.clock.now + self.spillover / 1000, 'spill', q)
+        # like wait_for_pool, get a minion started right away
+        self._wake()
+
+    def _finish(self):
+        done = []
+        for name, running in self.running.items():
+            if any(q.remaining <= 1e-9 for q in running):
+                done.extend(q for q in running if q.remaining <= 1e-9)
+                self.running[name] = [q for q in running if q.remaining > 1e-9]
+        # releasing starts waiting queries
+        for q in done:
+            q.finished = self.clock.now
+            self.finished += 1
+            q.claim.release()
+
+    def _tick(self):
+        now = self.clock.now
+        if now - self._last_refresh >= self._interval:
+            self.states.refresh()
+            self._last_refresh = now
+        for name, p in self.pools.items():
+            p.poll()
+            desired, _ = autoscale.decide(
+                self.policies[name], now, p.loadaverage, p.count('UP'),
+                len(p.members()), self.queues[name].depth)
+            p.desired = desired
+            # members may have come up
+            self._dispatch(name)
+
+        if any(p.transitional() for p in self.pools.values()):
+            self._interval = POLL_INTERVAL
+        else:
+            self._interval = min(2 * self._interval, MAX_POLL_INTERVAL)
+        self._next_tick = None
+        self._schedule_tick(now + self._interval)
+
+    def run(self):
+        for q in self.queries:
+            self._push(q.arrival, 'arrival', q)
+        self._schedule_tick(0.0)
+        while self.finished < len(self.queries):
+            t, _, kind, item = self._events[0]
+            completion = self._next_completion()
+            if completion <= t:
+                self._advance(completion)
+                self._finish()
+                continue
+            heapq.heappop(self._events)
+            self._advance(t)
+            if kind == 'arrival':
+                self._arrive(item)
+            elif kind == 'deadline':
+                if item in self.waiting[item.pool_name]:
+                    self._collect(item.pool_name)
+            elif kind == 'spill':
+                if item in self.waiting[item.pool_name]:
+                    self._spill(item, False)
+            elif t == self._next_tick:
+                self._tick()
+            # else a tick that was rescheduled earlier
+
+    def report(self):
+        served = [q for q in self.queries if not q.rejected]
+        latencies = [q.finished - q.arrival for q in served]
+        waits = [q.started - q.arrival for q in served]
+        elapsed = self.clock.now
+        return dict(
+            queries=len(self.queries),
+            rejected=len(self.queries) - len(served),
+            spilled=self.spilled,
+            p50=percentile(latencies, 50),
+            p95=percentile(latencies, 95),
+            p99=percentile(latencies, 99),
+            max=max(latencies, default=0),
+            wait_p95=percentile(waits, 95),
+            mean_queue=self.queue_area / elapsed if elapsed else 0,
+            max_queue=self.max_queue,
+            vm_hours=self.vm_seconds / 3600,
+            hours=elapsed / 3600,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a query trace against simulated pools")
+    parser.add_argument('trace')
+    parser.add_argument('--policy', choices=sorted(autoscale.POLICIES), help="default: compare all")
+    parser.add_argument('--pools', default='SMALL,LARGE', help="comma separated pool names")
+    parser.add_argument('--types', default='t2.small,t2.large', help="comma separated instance type per pool")
+    parser.add_argument('--members', type=int, default=8, help="members per pool")
+    parser.add_argument('--cores', type=int, default=2, help="queries a minion runs at full speed")
+    parser.add_argument('--boot', type=float, default=90, help="seconds for an instance to start")
+    parser.add_argument('--stop', type=float, default=30, help="seconds for an instance to stop")
+    parser.add_argument('--duration', type=float, default=20, help="mean query duration for timelines")
+    parser.add_argument('--spillover', default='never', help="'never', 'idle' or milliseconds, see Backend.spillover")
+    parser.add_argument('--ordering', choices=['fifo', 'priority'], default='fifo', help="admission queue ordering")
+    parser.add_argument('--max-depth', type=int, default=100, help="queries an admission queue holds")
+    parser.add_argument('--deadline', type=float, help="seconds a query may wait for a minion")
+    parser.add_argument('--weigh-load', action='store_true', help="see Pool.weigh_load")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--verbose', action='store_true', help="show what the pools print")
+    args = parser.parse_args()
+
+    pool_names = args.pools.split(',')
+    instance_types = args.types.split(',')
+    if len(instance_types) != len(pool_names):
+        parser.error("need an instance type for every pool")
+    spillover = args.spillover
+    if spillover not in ('never', 'idle'):
+        try:
+            spillover = int(spillover)
+        except ValueError:
+            parser.error("spillover must be 'never', 'idle' or a number of milliseconds")
+    admission_options = dict(max_depth=args.max_depth, ordering=args.ordering, deadline=args.deadline)
+    policies = [args.policy] if args.policy else sorted(autoscale.POLICIES)
+    for policy_name in policies:
+        # the claim strategies use the random module
+        random.seed(args.seed)
+        queries = load_queries(args.trace, pool_names, args.duration, args.seed)
+        sim = Simulation(queries, pool_names, autoscale.POLICIES[policy_name],
+                         args.members, args.cores, args.boot, args.stop,
+                         instance_types, spillover, admission_options, args.weigh_load)
+        if args.verbose:
+            sim.run()
+        else:
+            # Pool and Minion print every change
+            with contextlib.redirect_stdout(io.StringIO()):
+                sim.run()
+        r = sim.report()
+        print(f"{policy_name:>9}: {r['queries']} queries in {r['hours']:.2f}h, "
+              f"latency p50 {r['p50']:.1f}s p95 {r['p95']:.1f}s p99 {r['p99']:.1f}s max {r['max']:.1f}s, "
+              f"wait p95 {r['wait_p95']:.1f}s, queue mean {r['mean_queue']:.2f} max {r['max_queue']}, "
+              f"{r['rejected']} rejected, {r['spilled']} spilled, {r['vm_hours']:.2f} VM-hours")
+
+
+if __name__ == "__main__":
+    main()
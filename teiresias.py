@@ -1,68 +1,770 @@
 #!/usr/bin/env python3
 
+from array import array
+from collections import OrderedDict, defaultdict, deque, namedtuple
 import pymonetdb
 import pprint
+import mmap
+import os
 import re
+import struct
+import sys
+import threading
+import weakref
+
+import malplan
+
+class _Layout(dict):
+    # a dict that can be weakly referenced, see Storage._layouts
+    __slots__ = ('__weakref__',)
+
 
 class Storage:
+    """Column sizes and table row counts.
+
+    The sizes live in one int64 array. The columns of a table occupy a
+    contiguous range in it and a layout dict maps column names to offsets
+    in that range. Tables with the same columns, such as the same table
+    in different schemas, share their layout, so per column we only pay
+    eight bytes. total_size() adds up a whole set of columns in one call.
+
+    Next to each size we keep the number of distinct values in the
+    column, or -1 if we don't know.
+    """
+
     def __init__(self):
-        self.colsizes = {}
+        self._sizes = array('q')
+        self._distinct = array('q')
+        # (schema, table) -> (start, layout)
+        self._tables = {}
+        # tuple of column names -> layout, a dict column -> offset. Only
+        # the layouts tables use, the ones a growing table leaves behind go
+        self._layouts = weakref.WeakValueDictionary()
+        # (schema, table) -> row count
+        self.rowcounts = {}
+        self._count = 0
+        # slots in _sizes that no longer belong to a table
+        self._dead = 0
+        # set when _sizes is a view on a snapshot file
+        self._mapping = None
 
     def __str__(self):
-       return str(self.colsizes)
+       return str(dict(self.items()))
+
+    def __eq__(self, other):
+        return (dict(self.items()) == dict(other.items())
+                and self.rowcounts == other.rowcounts
+                and self._distinct_items() == other._distinct_items())
+
+    def copy(self):
+        other = Storage()
+        other._layouts = weakref.WeakValueDictionary(self._layouts)
+        if self._dead * 4 > len(self._sizes):
+            # worth compacting
+            for (schema, table), (start, layout) in self._tables.items():
+                end = start + len(layout)
+                other._add_table(schema, table, layout, self._sizes[start:end], self._distinct[start:end])
+        else:
+            other._sizes = array('q', self._sizes)
+            other._distinct = array('q', self._distinct)
+            other._tables = dict(self._tables)
+            other._count = self._count
+            other._dead = self._dead
+        other.rowcounts = dict(self.rowcounts)
+        return other
+
+    def _layout(self, columns):
+        columns = tuple(columns)
+        layout = self._layouts.get(columns)
+        if layout is None:
+            layout = _Layout((sys.intern(c), i) for i, c in enumerate(columns))
+            self._layouts[columns] = layout
+        return layout
+
+    def _add_table(self, schema, table, columns, sizes, distinct=None):
+        layout = self._layout(columns)
+        key = (sys.intern(schema), sys.intern(table))
+        self._tables[key] = (len(self._sizes), layout)
+        self._sizes.extend(sizes)
+        if distinct is None:
+            self._distinct.extend([-1] * len(layout))
+        else:
+            self._distinct.extend(distinct)
+        self._count += len(layout)
+
+    def _make_writable(self):
+        # a Storage loaded from a snapshot refers to the mapped file
+        if not isinstance(self._sizes, array):
+            self._sizes = array('q', self._sizes)
+            self._distinct = array('q', self._distinct)
+            self._mapping = None
+
+    def set_table(self, schema, table, columns, sizes, distinct=None):
+        """Replace all column sizes of a table at once"""
+        if any(size < 0 for size in sizes):
+            raise ValueError("size musn't be negative")
+        self._make_writable()
+        self._remove_columns(schema, table)
+        self._add_table(schema, table, columns, sizes, distinct)
 
     def set_colsize(self, schema, table, column, size):
         if size < 0:
             raise ValueError("size musn't be negative")
-        self.colsizes[schema +"." + table + "." + column] = size;
+        self._make_writable()
+        entry = self._tables.get((schema, table))
+        if not entry:
+            self._add_table(schema, table, [column], [size])
+            return
+        start, layout = entry
+        offset = layout.get(column)
+        if offset is not None:
+            self._sizes[start + offset] = size
+            return
+        columns = list(layout) + [column]
+        if start + len(layout) == len(self._sizes):
+            # last table in the array, it can simply grow
+            self._tables[(schema, table)] = (start, self._layout(columns))
+            self._sizes.append(size)
+            self._distinct.append(-1)
+            self._count += 1
+        else:
+            end = start + len(layout)
+            sizes = list(self._sizes[start:end]) + [size]
+            distinct = list(self._distinct[start:end]) + [-1]
+            self.set_table(schema, table, columns, sizes, distinct)
 
     def get_colsize(self, schema, table, column):
-        return self.colsizes[schema +"." + table + "." + column]
+        start, layout = self._tables[(schema, table)]
+        return self._sizes[start + layout[column]]
+
+    def set_distinct(self, schema, table, column, n):
+        self._make_writable()
+        start, layout = self._tables[(schema, table)]
+        self._distinct[start + layout[column]] = n
+
+    def get_distinct(self, schema, table, column):
+        """Number of distinct values in the column, None if unknown"""
+        entry = self._tables.get((schema, table))
+        if not entry:
+            return None
+        offset = entry[1].get(column)
+        if offset is None:
+            return None
+        n = self._distinct[entry[0] + offset]
+        return n if n >= 0 else None
+
+    def _distinct_items(self):
+        distinct = self._distinct
+        return dict(
+            ((schema, table, column), distinct[start + offset])
+            for (schema, table), (start, layout) in self._tables.items()
+            for column, offset in layout.items()
+        )
 
     def get_colsize_by_key(self, key):
-        return self.colsizes[key]
+        return self.get_colsize(*key)
 
     def get_keys(self):
-        return self.colsizes.keys()
+        """Return the (schema, table, column) triples we know about"""
+        return [key for key, _ in self.items()]
+
+    def items(self):
+        sizes = self._sizes
+        for (schema, table), (start, layout) in self._tables.items():
+            for column, offset in layout.items():
+                yield (schema, table, column), sizes[start + offset]
+
+    def total_size(self, columns):
+        """Sum of the sizes of the given (schema, table, column) triples"""
+        tables = self._tables
+        sizes = self._sizes
+        total = 0
+        for schema, table, column in columns:
+            start, layout = tables[(schema, table)]
+            total += sizes[start + layout[column]]
+        return total
+
+    def set_rowcount(self, schema, table, count):
+        self.rowcounts[(schema, table)] = count
+
+    def get_rowcount(self, schema, table):
+        return self.rowcounts.get((schema, table))
+
+    def tables(self):
+        return self.rowcounts.keys()
+
+    def _remove_columns(self, schema, table):
+        entry = self._tables.pop((schema, table), None)
+        if entry:
+            n = len(entry[1])
+            self._count -= n
+            self._dead += n
+
+    def remove_table(self, schema, table):
+        self._remove_columns(schema, table)
+        self.rowcounts.pop((schema, table), None)
 
     def count(self):
-        return len(self.colsizes)
+        return self._count
+
+_STORAGE_QUERY = 'SELECT schema, table, column, count, columnsize + heapsize + hashes + imprints + orderidx AS colsize, "unique" FROM sys.storage'
+
+# Distinct value counts gathered by ANALYZE. Older versions keep the
+# count in "unique", newer ones only a boolean. Not all versions have
+# this so it's best effort.
+_STATISTICS_QUERY = """SELECT s.name, t.name, c.name, st."unique"
+FROM sys.statistics st, sys.columns c, sys._tables t, sys.schemas s
+WHERE st.column_id = c.id AND c.table_id = t.id AND t.schema_id = s.id"""
+
+def _add_storage_rows(strg, rows):
+   tables = OrderedDict()
+   for schema, table, column, count, colsize, unique in rows:
+       columns, sizes, distinct, rowcount = tables.get((schema, table)) or ([], [], [], count)
+       columns.append(column)
+       sizes.append(colsize)
+       distinct.append(count if unique else -1)
+       tables[(schema, table)] = (columns, sizes, distinct, max(count, rowcount))
+   for (schema, table), (columns, sizes, distinct, rowcount) in tables.items():
+       strg.set_table(schema, table, columns, sizes, distinct)
+       strg.set_rowcount(schema, table, rowcount)
+
+def _add_statistics(conn, strg, tables=None):
+   c = conn.cursor()
+   try:
+       c.execute(_STATISTICS_QUERY)
+       rows = c.fetchall()
+   except Exception:
+       # don't leave the connection in an aborted transaction
+       conn.rollback()
+       return
+   for schema, table, column, unique in rows:
+       if tables is not None and (schema, table) not in tables:
+           continue
+       if isinstance(unique, bool) or not isinstance(unique, int) or unique < 0:
+           continue
+       if strg.get_distinct(schema, table, column) is None:
+           try:
+               strg.set_distinct(schema, table, column, unique)
+           except KeyError:
+               pass
 
 def get_storage(conn):
    strg = Storage()
 
    c = conn.cursor()
-   c.execute('SELECT schema, table, column, columnsize + heapsize + hashes + imprints + orderidx AS colsize FROM sys.storage()')
-   for row in c.fetchall():
-       strg.set_colsize(row[0], row[1], row[2], row[3])
+   c.execute(_STORAGE_QUERY + '()')
+   _add_storage_rows(strg, c.fetchall())
+   _add_statistics(conn, strg)
+   return strg
+
+def refresh_storage(conn, old):
+   """Return a copy of old with fresh statistics for the tables whose row
+   count has changed, or old itself if no table changed."""
+   c = conn.cursor()
+   c.execute('SELECT schema, table, MAX(count) FROM sys.storage() GROUP BY schema, table')
+   counts = dict(((schema, table), count) for schema, table, count in c.fetchall())
+
+   changed = [t for t, n in counts.items() if old.get_rowcount(*t) != n]
+   gone = [t for t in old.tables() if t not in counts]
+   if not changed and not gone:
+       return old
+
+   strg = old.copy()
+   for schema, table in gone:
+       strg.remove_table(schema, table)
+   for schema, table in changed:
+       strg.remove_table(schema, table)
+       c.execute(_STORAGE_QUERY + '(%s, %s)', (schema, table))
+       _add_storage_rows(strg, c.fetchall())
+   _add_statistics(conn, strg, set(changed))
+   return strg
+
+# Snapshot file layout, all integers little endian int64:
+#   magic, then a header of 6 integers:
+#     length of the names blob, number of layouts, number of tables,
+#     number of sizes, number of layout columns, length of database name
+#   names blob: database name, then the column names of all layouts,
+#     then schema and table name of each table, NUL separated
+#   padding up to a multiple of 8
+#   layout lengths, table starts, table layout numbers, table row counts
+#   (-1 if unknown), sizes, distinct counts (-1 if unknown)
+# The sizes are used straight from the mapped file until the Storage
+# is modified.
+_SNAPSHOT_MAGIC = b'MDBSTOR2'
+_SNAPSHOT_HEADER = struct.Struct('<8s6q')
+
+def save_storage(storage, path, database):
+   """Write storage to a snapshot file, replacing it atomically"""
+   layouts = {}
+   for start, layout in storage._tables.values():
+       layouts.setdefault(id(layout), layout)
+   layout_numbers = dict((key, i) for i, key in enumerate(layouts))
+
+   names = [database]
+   for layout in layouts.values():
+       names.extend(layout)
+   tables = list(storage._tables.items())
+   for (schema, table), _ in tables:
+       names.append(schema)
+       names.append(table)
+   for name in names:
+       if '\0' in name:
+           raise ValueError(f"can't store name containing NUL: {name!r}")
+   blob = '\0'.join(names).encode('utf-8')
+   blob += b'\0' * (-len(blob) % 8)
+
+   ints = array('q')
+   ints.extend(len(layout) for layout in layouts.values())
+   ints.extend(start for (_, (start, _)) in tables)
+   ints.extend(layout_numbers[id(layout)] for (_, (_, layout)) in tables)
+   ints.extend(storage.rowcounts.get(key, -1) for key, _ in tables)
+   ints.extend(storage._sizes)
+   ints.extend(storage._distinct)
+   if sys.byteorder != 'little':
+       ints.byteswap()
+
+   header = _SNAPSHOT_HEADER.pack(
+       _SNAPSHOT_MAGIC, len(blob), len(layouts), len(tables), len(storage._sizes),
+       sum(len(layout) for layout in layouts.values()), len(database.encode('utf-8')))
+   tmp = path + '.tmp'
+   with open(tmp, 'wb') as f:
+       f.write(header)
+       f.write(blob)
+       f.write(ints.tobytes())
+   os.replace(tmp, path)
+
+def load_storage(path, database):
+   """Load a snapshot written by save_storage.
+
+   Returns None if the file does not exist, is damaged or belongs to
+   another database.
+   """
+   try:
+       f = open(path, 'rb')
+   except FileNotFoundError:
+       return None
+   with f:
+       try:
+           mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+       except ValueError:
+           # empty file
+           return None
+   try:
+       return _load_storage(mapping, database)
+   except (ValueError, struct.error, UnicodeDecodeError, IndexError) as e:
+       print(f"Ignoring storage snapshot {path}: {e}")
+       return None
+
+def _load_storage(mapping, database):
+   magic, blob_len, nlayouts, ntables, nsizes, ncolumns, dblen = _SNAPSHOT_HEADER.unpack_from(mapping)
+   if magic != _SNAPSHOT_MAGIC:
+       raise ValueError("not a storage snapshot")
+   pos = _SNAPSHOT_HEADER.size
+   if mapping[pos:pos + dblen].decode('utf-8') != database:
+       return None
+   names = mapping[pos:pos + blob_len].rstrip(b'\0').decode('utf-8').split('\0')
+   if len(names) != 1 + ncolumns + 2 * ntables:
+       raise ValueError("names don't match header")
+   pos += blob_len
+   nints = nlayouts + 3 * ntables + 2 * nsizes
+   if len(mapping) != pos + 8 * nints:
+       raise ValueError("unexpected file size")
+   ints = memoryview(mapping)[pos:].cast('q')
+   if sys.byteorder != 'little':
+       ints = array('q', ints)
+       ints.byteswap()
+
+   strg = Storage()
+   layouts = []
+   n = 1
+   for length in ints[:nlayouts]:
+       layouts.append(strg._layout(names[n:n + length]))
+       n += length
+   starts = ints[nlayouts:nlayouts + ntables]
+   layout_numbers = ints[nlayouts + ntables:nlayouts + 2 * ntables]
+   rowcounts = ints[nlayouts + 2 * ntables:nlayouts + 3 * ntables]
+   for i in range(ntables):
+       schema = sys.intern(names[n])
+       table = sys.intern(names[n + 1])
+       n += 2
+       layout = layouts[layout_numbers[i]]
+       if starts[i] + len(layout) > nsizes:
+           raise ValueError("table out of range")
+       strg._tables[(schema, table)] = (starts[i], layout)
+       if rowcounts[i] >= 0:
+           strg.rowcounts[(schema, table)] = rowcounts[i]
+       strg._count += len(layout)
+   strg._sizes = ints[nlayouts + 3 * ntables:nlayouts + 3 * ntables + nsizes]
+   strg._distinct = ints[nlayouts + 3 * ntables + nsizes:]
+   strg._dead = nsizes - strg._count
+   strg._mapping = mapping
    return strg
 
+# comments, quoted identifiers, string literals, numbers, whitespace
+_TOKEN = re.compile(r"""
+      (?P<comment> --[^\n]* | /\*.*?\*/ )
+    | (?P<ident> "(?:[^"]|"")*" )
+    | (?P<string> [eErR]?'(?:[^'\\]|''|\\.)*' )
+    | (?P<number> (?<![\w.])(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)? )
+    | (?P<space> \s+ )
+""", re.VERBOSE | re.DOTALL)
+
+def fingerprint(query):
+    """Normalize the query text so that queries which only differ in
+    whitespace, comments, case or literal values map to the same string."""
+    def repl(m):
+        kind = m.lastgroup
+        if kind == 'ident':
+            return m.group()
+        elif kind == 'string' or kind == 'number':
+            return '?'
+        else:
+            # whitespace and comments
+            return ' '
+    parts = []
+    pos = 0
+    for m in _TOKEN.finditer(query):
+        parts.append(query[pos:m.start()].lower())
+        parts.append(repl(m))
+        pos = m.end()
+    parts.append(query[pos:].lower())
+    return re.sub(' +', ' ', ''.join(parts)).strip(' ;')
+
+def normalize(query):
+    """Like fingerprint but literal values are kept, so only queries that
+    must give the same result map to the same string."""
+    parts = []
+    pos = 0
+    for m in _TOKEN.finditer(query):
+        if m.start() > pos:
+            parts.append(query[pos:m.start()].lower())
+        if m.lastgroup == 'space' or m.lastgroup == 'comment':
+            # code between tokens never contains whitespace so a single
+            # space is always one of ours
+            if not parts or parts[-1] != ' ':
+                parts.append(' ')
+        else:
+            parts.append(m.group())
+        pos = m.end()
+    parts.append(query[pos:].lower())
+    return ''.join(parts).strip(' ;')
+
+# statements and functions whose results we can't reuse
+_NOT_REUSABLE = re.compile(r"""
+    \b(
+        insert | update | delete | merge | copy | create | drop | alter | truncate
+      | grant | revoke | call | next\s+value | now | rand | uuid
+      | current_date | current_time | current_timestamp | localtime | localtimestamp
+      | current_user | session_user | current_schema | current_sessionid
+        # monitoring functions and views, with or without sys.
+      | queue | sessions | storage | storagemodel | tracelog | prepared_statements
+      | querylog_calls | querylog_catalog | querylog_history
+    )\b
+    # or any other sys function
+  | \bsys \s* \. \s* \w+ \s* \(
+""", re.VERBOSE)
+
+def is_read_only(query):
+    """True if query is a single SELECT or WITH statement that gives the
+    same result every time as long as the data doesn't change. Queries
+    calling sys functions or looking at the monitoring views such as
+    sys.queue() and sys.sessions are not."""
+    code = fingerprint(query)
+    if ';' in code:
+        return False
+    words = code.lstrip('( ').split(None, 1)
+    if not words or words[0] not in ('select', 'with'):
+        return False
+    return not _NOT_REUSABLE.search(code)
+
+class PlanCache:
+    """LRU cache from query fingerprint to the malplan.PlanSummary of its
+    plan, which holds among others the set of (schema, table, column)
+    triples the plan binds.
+
+    The cache belongs to one Storage snapshot. When it is used with a
+    different snapshot all entries are dropped.
+    """
+
+    def __init__(self, max_size=1000):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._storage = None
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def _check_storage(self, storage):
+        if storage is not self._storage:
+            self._entries.clear()
+            self._storage = storage
+
+    def get(self, fp, storage):
+        with self._lock:
+            self._check_storage(storage)
+            summary = self._entries.get(fp)
+            if summary is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(fp)
+            self.hits += 1
+            return summary
+
+    def put(self, fp, storage, summary):
+        with self._lock:
+            self._check_storage(storage)
+            self._entries[fp] = summary
+            self._entries.move_to_end(fp)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                size=len(self._entries),
+                hits=self.hits,
+                misses=self.misses,
+            )
+
+class MemoryModel:
+    """Estimate the memory a query needs from the shape of its plan.
+
+    Columns that are selected on or joined are scanned completely, other
+    columns are only fetched for the rows that survive the selections on
+    their table. On top of that come the candidate lists produced by the
+    selections and the oid pairs and hash table of each join.
+    Selectivities come from the distinct counts in the Storage where we
+    have them and from the defaults below where we don't.
+    """
+
+    eq_selectivity = 0.1
+    range_selectivity = 1.0 / 3
+    like_selectivity = 0.1
+    notnil_selectivity = 0.9
+    # size of an oid in candidate lists and join results
+    oid_width = 8
+    # extra room on top of the estimate, the plain column sum uses 2
+    headroom = 1.25
+
+    def selectivity(self, select, storage):
+        if select.kind in ('eq', 'ne'):
+            distinct = storage.get_distinct(*select.column)
+            eq = 1.0 / distinct if distinct else self.eq_selectivity
+            return eq if select.kind == 'eq' else 1.0 - eq
+        elif select.kind == 'like':
+            return self.like_selectivity
+        elif select.kind == 'notnil':
+            return self.notnil_selectivity
+        else:
+            return self.range_selectivity
+
+    def _rows(self, table, storage):
+        return storage.get_rowcount(*table) or 0
+
+    def footprint(self, summary, storage):
+        table_selectivity = defaultdict(lambda: 1.0)
+        scanned = set()
+        total = 0.0
+
+        for select in summary.selects:
+            table = select.column[:2]
+            sel = self.selectivity(select, storage)
+            table_selectivity[table] *= sel
+            scanned.add(select.column)
+            total += self.oid_width * self._rows(table, storage) * sel
+
+        for join in summary.joins:
+            scanned.update(c for c in (join.left, join.right) if c)
+
+        for column in summary.columns:
+            size = storage.get_colsize(*column)
+            if column in scanned:
+                total += size
+            else:
+                total += size * table_selectivity[column[:2]]
+
+        for join in summary.joins:
+            total += self._join_footprint(join, table_selectivity, storage)
+
+        return int(total)
+
+    def _join_footprint(self, join, table_selectivity, storage):
+        if not join.left or not join.right:
+            return 0
+        left = self._rows(join.left[:2], storage) * table_selectivity[join.left[:2]]
+        right = self._rows(join.right[:2], storage) * table_selectivity[join.right[:2]]
+        if join.kind == 'cross':
+            out = left * right
+        elif join.kind == 'semi':
+            out = left
+        else:
+            distinct = max(storage.get_distinct(*join.left) or 0,
+                           storage.get_distinct(*join.right) or 0)
+            if distinct:
+                out = left * right / distinct
+            else:
+                # assume a foreign key join
+                out = max(left, right)
+        # two oid columns for the result plus a hash table on one side
+        return 2 * self.oid_width * out + self.oid_width * min(left, right)
+
+    def required_memory(self, summary, storage):
+        return self.footprint(summary, storage) * self.headroom
+
+Sample = namedtuple('Sample', ['duration', 'rows', 'peak_memory'])
+
+class History:
+    """What we saw when queries actually ran, per query fingerprint.
+
+    Keeps the last samples_per_query samples of at most max_queries
+    fingerprints, least recently used fingerprints are forgotten first.
+    """
+
+    def __init__(self, max_queries=1000, samples_per_query=20, min_samples=3):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.max_queries = max_queries
+        self.samples_per_query = samples_per_query
+        # don't trust the observations before we have this many
+        self.min_samples = min_samples
+
+    def record(self, fp, duration, rows, peak_memory=None):
+        with self._lock:
+            samples = self._entries.get(fp)
+            if samples is None:
+                samples = deque(maxlen=self.samples_per_query)
+                self._entries[fp] = samples
+            self._entries.move_to_end(fp)
+            samples.append(Sample(duration, rows, peak_memory))
+            while len(self._entries) > self.max_queries:
+                self._entries.popitem(last=False)
+
+    def samples(self, fp):
+        with self._lock:
+            return list(self._entries.get(fp, ()))
+
+    def observed_memory(self, fp):
+        """Highest peak memory seen in the recent samples, or None if we
+        don't have enough samples with a peak memory."""
+        peaks = [s.peak_memory for s in self.samples(fp) if s.peak_memory is not None]
+        if len(peaks) < self.min_samples:
+            return None
+        return max(peaks)
+
+    def mean_duration(self, fp):
+        samples = self.samples(fp)
+        if len(samples) < self.min_samples:
+            return None
+        return sum(s.duration for s in samples) / len(samples)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                queries=len(self._entries),
+                samples=sum(len(s) for s in self._entries.values()),
+            )
+
+# The footprint column of sys.queue() is there since Jun2020. The query
+# itself shows up as running, we want the one that finished before it.
+_PEAK_MEMORY_QUERY = """SELECT footprint FROM sys.queue()
+WHERE sessionid = sys.current_sessionid() AND status <> 'running'
+ORDER BY started DESC LIMIT 1"""
+
+# What older versions of MonetDB say about _PEAK_MEMORY_QUERY, e.g.
+# "SELECT: identifier 'footprint' unknown"
+_PEAK_MEMORY_UNSUPPORTED = re.compile(r"identifier '\w+' unknown|no such \w+( \w+)* '\w+'")
+
+def peak_memory(conn):
+    """Return the peak memory in bytes of the last query that finished on
+    this connection, or None if MonetDB doesn't know. Raises
+    NotImplementedError if this version of MonetDB can't tell us at all,
+    other errors are passed on."""
+    # sys.queue() reports the footprint in MB
+    c = conn.cursor()
+    try:
+        c.execute(_PEAK_MEMORY_QUERY)
+    except Exception as e:
+        if _PEAK_MEMORY_UNSUPPORTED.search(str(e)):
+            raise NotImplementedError(str(e)) from e
+        raise
+    row = c.fetchone()
+    c.close()
+    if not row or row[0] is None:
+        return None
+    return int(row[0]) * 1024 * 1024
+
+def pick_machine(needed, machine_specs):
+    """Return the smallest machine with more than needed bytes of memory,
+    or the largest machine if none has enough."""
+    # sort machine_specs by values
+    for machine, mem in sorted(machine_specs.items(), key = lambda
+            machine_specs:(machine_specs[1], machine_specs[0])):
+        if needed < mem:
+            return machine
+    return machine;
+
 class Adviser:
-    def __init__(self, conn, storage):
+    # extra room on top of the peak memory we observed
+    observed_headroom = 1.2
+    # observations more than this many times below the estimate from the
+    # plan are suspect, we stick to the estimate then
+    suspect_ratio = 10
+
+    def __init__(self, conn, storage, plan_cache=None, model=None, history=None):
         self.conn = conn
         self.storage = storage
+        self.plan_cache = plan_cache
+        # a MemoryModel, or None to size by the plain column sum
+        self.model = model
+        # a History, if we have it we prefer what we saw over what we guess
+        self.history = history
 
-    def _get_name(self, _str):
-        m = re.search(":", _str)
-        return m.string[1:m.end()-2]
+    def summary(self, query):
+        cache = self.plan_cache
+        if cache:
+            fp = fingerprint(query)
+            summary = cache.get(fp, self.storage)
+            if summary is not None:
+                return summary
 
-    def estimate(self, query):
         c = self.conn.cursor()
         c.execute('explain ' + query)
-        totalsize = 0
-        columns = set()
-        for row in c.fetchall():
-            if re.search("sql.bind\(.*", str(row)) != None:
-                substrs = re.split('\s+', str(row))
-                schema = self._get_name(substrs[4])
-                table  = self._get_name(substrs[5])
-                column = self._get_name(substrs[6])
-                columns.add((schema,table,column))
-        for schema, table, column in columns:
-                size = self.storage.get_colsize(schema, table, column)
-                totalsize += size
-        return totalsize
+        rows = c.fetchall()
+        if self.model:
+            summary = malplan.summarize(rows)
+        else:
+            # the column sum only needs the columns, and
+            # bound_columns is a lot quicker
+            summary = malplan.PlanSummary(malplan.bound_columns(rows), None, None, None)
+
+        if cache:
+            cache.put(fp, self.storage, summary)
+        return summary
 
+    def columns(self, query):
+        return self.summary(query).columns
+
+    def estimate(self, query):
+        columns = self.columns(query)
+        return self.storage.total_size(columns)
+
+    def required_memory(self, query):
+        if self.model:
+            estimate = self.model.required_memory(self.summary(query), self.storage)
+        else:
+            # extra mem is for intermediates
+            estimate = self.estimate(query) * 2
+        if self.history:
+            observed = self.history.observed_memory(fingerprint(query))
+            if observed is not None:
+                needed = observed * self.observed_headroom
+                if needed * self.suspect_ratio >= estimate:
+                    return needed
+        return estimate
 
     # machine_specs is expected to be a dictionary containing:
     # {
@@ -71,23 +773,16 @@ class Adviser:
     # ...
     # }
     def advise(self, query, machine_specs):
-        totalsize = self.estimate(query)
-        # print("Totalsize: " + str(totalsize))
-
-        # sort machine_specs by values
-        for machine, mem in sorted(machine_specs.items(), key = lambda
-                machine_specs:(machine_specs[1], machine_specs[0])):
-            # extra mem is for intermediates
-            if totalsize * 2 < mem:
-                return machine
-        return machine;
+        needed = self.required_memory(query)
+        # print("Needed: " + str(needed))
+        return pick_machine(needed, machine_specs)
 
 # Examples to test the two main functions here, i.e. get_storage() and advise()
 def test_storage(conn):
     storage = get_storage(conn)
     print("No. columns in storage: " + str(storage.count()))
     for k in storage.get_keys():
-        print(k + ": " + str(storage.get_colsize_by_key(k)))
+        print(".".join(k) + ": " + str(storage.get_colsize_by_key(k)))
 
 def test_advise(conn, query):
     machine_specs = {}
@@ -0,0 +1,89 @@
+import pytest
+
+from admission import AdmissionQueue, Rejected
+from conftest import Clock
+
+
+class Members:
+    """claim function handing out up to free claims"""
+
+    def __init__(self, free=0):
+        self.free = free
+        self.given = 0
+
+    def __call__(self, footprint=None):
+        if self.free == 0:
+            return None
+        self.free -= 1
+        self.given += 1
+        return self.given
+
+
+def admitted(waiters):
+    return [w.client for w in waiters if w.wait(0)]
+
+
+def test_fifo():
+    members = Members()
+    q = AdmissionQueue('P', members, fair=False)
+    waiters = [q.enter(client, priority) for client, priority in [('a', 0), ('b', 5), ('c', 0)]]
+    assert q.depth == 3
+    members.free = 2
+    q.dispatch()
+    assert admitted(waiters) == ['a', 'b']
+    assert q.depth == 1
+
+
+def test_priority():
+    members = Members()
+    q = AdmissionQueue('P', members, ordering='priority', fair=False)
+    waiters = [q.enter(client, priority) for client, priority in [('a', 0), ('b', 5), ('c', 1)]]
+    members.free = 2
+    q.dispatch()
+    assert admitted(waiters) == ['b', 'c']
+
+
+def test_fair_takes_turns_per_client():
+    members = Members()
+    q = AdmissionQueue('P', members)
+    waiters = [q.enter(client) for client in ['a', 'a', 'a', 'b']]
+    members.free = 2
+    q.dispatch()
+    assert sorted(admitted(waiters)) == ['a', 'b']
+
+
+def test_max_depth():
+    q = AdmissionQueue('P', Members(), max_depth=2)
+    q.enter()
+    q.enter()
+    with pytest.raises(Rejected):
+        q.enter()
+    assert q.stats()['rejected'] == 1
+
+
+def test_deadline():
+    clock = Clock()
+    q = AdmissionQueue('P', Members(), clock=clock)
+    w = q.enter(deadline=10)
+    clock.advance(5)
+    assert w.wait(0) is None
+    clock.advance(6)
+    with pytest.raises(Rejected):
+        w.wait(0)
+    assert q.depth == 0
+    assert q.stats()['expired'] == 1
+
+
+def test_cancel_gives_back_granted_claim():
+    released = []
+
+    class Claim:
+        def release(self):
+            released.append(self)
+
+    q = AdmissionQueue('P', lambda footprint=None: Claim())
+    w = q.enter()
+    w.cancel()
+    w.cancel()
+    assert len(released) == 1
+    assert q.depth == 0
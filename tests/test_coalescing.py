@@ -0,0 +1,113 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('boto3')
+pytest.importorskip('pymonetdb')
+
+from admission import Rejected
+import conductor_backend
+
+
+def make_backend(execute):
+    # just what execute_query needs, no pools or threads
+    b = conductor_backend.Backend.__new__(conductor_backend.Backend)
+    b._minion_connector = conductor_backend.Connector('mapi:monetdb://localhost/demo')
+    b._results = None
+    b._flights = {}
+    b._flights_lock = threading.Lock()
+    b._coalesced = 0
+    b._execute = execute
+    return b
+
+
+def wait_until(condition):
+    for _ in range(5000):
+        if condition():
+            return
+        time.sleep(0.001)
+    assert condition()
+
+
+def test_concurrent_callers_share_one_execution():
+    started = threading.Event()
+    go = threading.Event()
+    calls = []
+
+    def execute(q, client, priority, deadline, key):
+        calls.append(q)
+        started.set()
+        go.wait(5)
+        return dict(query=q, rows=1)
+
+    b = make_backend(execute)
+    results = {}
+    leader = threading.Thread(target=lambda: results.update(leader=b.execute_query('SELECT 1')))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.update(follower=b.execute_query('select  1')))
+    follower.start()
+    wait_until(lambda: b._coalesced)
+    go.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert calls == ['SELECT 1']
+    assert 'coalesced' not in results['leader']
+    assert results['follower'] == dict(query='select  1', rows=1, coalesced=True)
+    assert not b._flights
+
+
+def test_rejected_leader_leaves_followers_to_try():
+    started = threading.Event()
+    go = threading.Event()
+    calls = []
+
+    def execute(q, client, priority, deadline, key):
+        calls.append(client)
+        if client == 'leader':
+            started.set()
+            go.wait(5)
+            raise Rejected("queue full")
+        return dict(query=q, rows=1)
+
+    b = make_backend(execute)
+    results = {}
+
+    def run(client):
+        try:
+            results[client] = b.execute_query('SELECT 1', client=client)
+        except Rejected as e:
+            results[client] = e
+
+    leader = threading.Thread(target=run, args=('leader',))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=run, args=('follower',))
+    follower.start()
+    wait_until(lambda: b._coalesced)
+    go.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert calls == ['leader', 'follower']
+    assert isinstance(results['leader'], Rejected)
+    assert results['follower'] == dict(query='SELECT 1', rows=1)
+
+
+def test_follower_gives_up_at_its_deadline():
+    go = threading.Event()
+
+    def execute(q, client, priority, deadline, key):
+        go.wait(5)
+        return dict(query=q, rows=1)
+
+    b = make_backend(execute)
+    leader = threading.Thread(target=b.execute_query, args=('SELECT 1',))
+    leader.start()
+    wait_until(lambda: b._flights)
+    with pytest.raises(Rejected):
+        b.execute_query('SELECT 1', deadline=0.05)
+    go.set()
+    leader.join(5)
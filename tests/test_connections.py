@@ -0,0 +1,34 @@
+from connections import ConnectionPool
+
+
+class Connection:
+    def __init__(self):
+        self.closed = False
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_discard_closes_later():
+    cp = ConnectionPool()
+    with cp.connection(('b', 1), Connection) as other:
+        pass
+    with cp.connection(('a', 1), Connection) as borrowed:
+        with cp.connection(('a', 1), Connection) as idle:
+            pass
+        cp.discard(lambda key: key[0] == 'a')
+        # discard doesn't touch the sockets
+        assert not idle.closed and not borrowed.closed
+    # borrowed when it was discarded, closed on return
+    assert borrowed.closed
+    assert not idle.closed
+    cp.evict_idle()
+    assert idle.closed
+    assert not other.closed
+    with cp.connection(('a', 1), Connection) as conn:
+        assert conn is not idle and conn is not borrowed
+    with cp.connection(('b', 1), Connection) as conn:
+        assert conn is other
@@ -0,0 +1,122 @@
+from conftest import Clock
+from fakes import FakeEC2
+import minions
+from minions import READY, RUNNING, STOPPED
+import pool
+
+
+def make_ec2(n, state=STOPPED, instance_type='t2.small', clock=None):
+    ec2 = FakeEC2(clock=clock or Clock(), start_delay=20, stop_delay=10)
+    for i in range(n):
+        ec2.add_instance(f"m{i:02d}", instance_type=instance_type, tags=dict(pool='P'), state=state)
+    return ec2
+
+
+def test_refresh_asks_ec2_once_for_all_minions():
+    ec2 = make_ec2(50)
+    cache = minions.InstanceStateCache(ec2, probe=lambda ip: True)
+    ms = minions.track_down_minions(ec2, dict(pool='P'), cache)
+    assert len(ms) == 50
+    before = ec2.describe_calls
+    cache.refresh()
+    for m in ms:
+        m.refresh()
+        m.poll()
+    assert ec2.describe_calls == before + 1
+    assert all(m.observed_state == STOPPED for m in ms)
+
+
+def test_refresh_in_batches():
+    ec2 = make_ec2(50)
+    cache = minions.InstanceStateCache(ec2, probe=lambda ip: True)
+    cache.batch_size = 20
+    minions.track_down_minions(ec2, dict(pool='P'), cache)
+    before = ec2.describe_calls
+    cache.refresh()
+    assert ec2.describe_calls == before + 3
+
+
+def test_only_running_instances_that_answer_are_ready():
+    ec2 = make_ec2(4, state=RUNNING)
+    ec2.add_instance("stopped", tags=dict(pool='P'))
+    answering = set()
+    cache = minions.InstanceStateCache(ec2, probe=lambda ip: ip in answering)
+    ms = dict((m.name, m) for m in minions.track_down_minions(ec2, dict(pool='P'), cache))
+    answering.update([ms['m00'].ip, ms['m02'].ip])
+    cache.refresh()
+    states = dict((name, cache.get(m.id).state) for name, m in ms.items())
+    assert states == dict(m00=READY, m01=RUNNING, m02=READY, m03=RUNNING, stopped=STOPPED)
+
+
+def test_resize_cycle():
+    clock = Clock()
+    ec2 = make_ec2(1, state=RUNNING, clock=clock)
+    cache = minions.InstanceStateCache(ec2, probe=lambda ip: True)
+    ms = minions.track_down_minions(ec2, dict(pool='P'), cache, clock)
+    m = ms[0]
+    p = pool.Pool('P', ms, clock=clock)
+
+    def run(seconds):
+        for _ in range(seconds):
+            clock.advance(1)
+            cache.refresh()
+            p.poll()
+
+    run(2)
+    assert p.members()[0][1] == 'UP'
+    assert p.resize('t2.large') == m.name
+    assert p.memory() == 8192 * 1024 * 1024
+    # not UP until it is READY with the new type
+    run(15)
+    assert p.members()[0][1] == 'STARTING'
+    assert p.claim() is None
+    run(60)
+    assert m.instance_type == 't2.large'
+    assert m.observed_state == READY
+    assert p.members()[0][1] == 'UP'
+
+    # a member that is finishing its queries keeps running at its size
+    claim = p.claim()
+    p.desired = 0
+    run(30)
+    assert p.members()[0][1] == 'FINISHING'
+    assert m.observed_state == READY
+    assert m.instance_type == 't2.large'
+
+    # once it is down it goes back to its own type
+    claim.release()
+    run(30)
+    assert p.members()[0][1] == 'DOWN'
+    assert m.observed_state == STOPPED
+    assert m.instance_type == 't2.small'
+    assert not p.transitional()
+
+
+def test_resize_given_up():
+    clock = Clock()
+    ec2 = make_ec2(1, state=RUNNING, clock=clock)
+
+    def no_capacity(**kwargs):
+        raise Exception("InsufficientInstanceCapacity")
+    ec2.meta.client.modify_instance_attribute = no_capacity
+    cache = minions.InstanceStateCache(ec2, probe=lambda ip: True)
+    ms = minions.track_down_minions(ec2, dict(pool='P'), cache, clock)
+    m = ms[0]
+    p = pool.Pool('P', ms, clock=clock)
+
+    def run(seconds):
+        for _ in range(seconds):
+            clock.advance(1)
+            cache.refresh()
+            p.poll()
+
+    run(2)
+    assert p.resize('t2.large') == m.name
+    # polling carries on, and after a few attempts the minion comes back
+    # up as it was
+    run(300)
+    assert m.failures == 0
+    assert m.instance_type == 't2.small'
+    assert not m.resizing
+    assert p.members()[0][1] == 'UP'
+    assert p.claim() is not None
@@ -0,0 +1,100 @@
+from collections import defaultdict
+import random
+
+from conftest import Clock
+from fakes import fake_minions
+import pool
+
+
+def rescan(p):
+    expected = defaultdict(set)
+    for name, state, claims, _ in p.members():
+        expected[state].add(name)
+        expected[(state, claims > 0)].add(name)
+    return expected
+
+
+def test_index_matches_rescan():
+    rng = random.Random(1)
+    p = pool.Pool('P', fake_minions(20), strategy=pool.LeastClaims())
+    claims = []
+    for _ in range(2000):
+        op = rng.random()
+        if op < 0.4:
+            c = p.claim(idle_only=rng.random() < 0.2)
+            if c:
+                claims.append(c)
+        elif op < 0.7 and claims:
+            claims.pop(rng.randrange(len(claims))).release()
+        elif op < 0.85:
+            p.desired = rng.randrange(21)
+        else:
+            p.poll()
+        indexed = dict((key, set(names)) for key, names in p.classify().items())
+        expected = rescan(p)
+        assert indexed == dict((key, names) for key, names in expected.items() if names)
+        for key in list(indexed) + ['UP', 'DOWN', ('UP', True), ('UP', False)]:
+            assert p.count(key) == len(expected[key])
+
+
+def test_claim_needs_room():
+    ms = fake_minions(3)
+    for m, gib in zip(ms, [4, 8, 16]):
+        m.memory = gib << 30
+    p = pool.Pool('P', ms)
+    big = p.claim(footprint=10 << 30)
+    assert big.name == ms[2].name
+    # nothing has room but the 16 GiB one will once it is done
+    assert p.claim(footprint=10 << 30) is None
+    big.release()
+    assert p.reserved()[ms[2].name] == 0
+    assert p.claim(footprint=10 << 30).name == ms[2].name
+    # too large for anyone, take the one with the most room
+    assert p.claim(footprint=100 << 30).name == ms[1].name
+
+
+def test_footprint_claim_follows_strategy():
+    ms = fake_minions(4)
+    for m in ms:
+        m.memory = 8 << 30
+    p = pool.Pool('P', ms, strategy=pool.LeastClaims())
+    claims = [p.claim(footprint=512 << 20) for _ in range(8)]
+    assert sorted(claims_per_member(p).values()) == [2, 2, 2, 2]
+    # a member without room is left out
+    p.claim(footprint=7 << 30)
+    full = [name for name, reserved in p.reserved().items() if reserved > 7 << 30]
+    assert len(full) == 1
+    for _ in range(6):
+        assert p.claim(footprint=1 << 30).name != full[0]
+
+
+def claims_per_member(p):
+    return dict((name, claims) for name, _, claims, _ in p.members())
+
+
+def test_background_claims_are_not_load():
+    clock = Clock()
+    p = pool.Pool('P', fake_minions(1), clock=clock)
+    clock.advance(100)
+    p.claim(background=True).release()
+    assert p.loadaverage.load == 0
+    assert p.loadaverage.time_since_change == 100
+    p.claim().release()
+    assert p.loadaverage.time_since_change == 0
+
+
+def test_spilled_claims_count_for_the_pool_they_were_meant_for():
+    clock = Clock()
+    small = pool.Pool('S', fake_minions(1, 's'), clock=clock)
+    large = pool.Pool('L', fake_minions(1, 'l'), clock=clock)
+    c = large.claim()
+    small.carry(c)
+    assert small.loadaverage.load == 1
+    assert large.loadaverage.load == 1
+    clock.advance(60)
+    c.release()
+    c.release()
+    assert small.loadaverage.load == 1
+    assert large.loadaverage.load == 1
+    clock.advance(60)
+    assert round(small.loadaverage.load, 6) == 0.5